@@ -0,0 +1,226 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+In-process caches for upstream API responses and metadata.
+"""
+
+import collections
+import copy
+import json
+import re
+import sys
+import threading
+import time
+
+
+def make_key(backend, method, path, body, params):
+  """Build a cache key for an upstream request"""
+  # Sort the body keys so that equivalent requests share an entry
+  # regardless of how the handler happened to build the dict.
+  return '\n'.join([backend, method, path,
+                    json.dumps(body, sort_keys=True) if body else '',
+                    params or ''])
+
+
+class ResponseCache(object):
+  """A thread-safe LRU cache of raw upstream response bodies.
+
+  The cache is bounded by the total size of the stored bodies. Entries
+  expire after a time-to-live chosen from a list of (path regex, seconds)
+  rules; paths matching no rule are not cached.
+  """
+
+  def __init__(self, max_bytes, ttls):
+    self.max_bytes = max_bytes
+    self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get_ttl(self, path):
+    for pattern, ttl in self.ttls:
+      if pattern.search(path):
+        return ttl
+    return 0
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      expires, content = entry
+      if expires < time.time():
+        self._bytes -= len(content)
+        self.expirations += 1
+        self.misses += 1
+        return None
+
+      # Re-insert to mark the entry as most recently used
+      self._entries[key] = entry
+      self.hits += 1
+      return content
+
+  def put(self, key, path, content):
+    ttl = self.get_ttl(path)
+    size = len(content)
+    if ttl <= 0 or size > self.max_bytes:
+      return
+
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self._bytes -= len(old[1])
+
+      self._entries[key] = (time.time() + ttl, content)
+      self._bytes += size
+
+      while self._bytes > self.max_bytes:
+        _, (_, evicted) = self._entries.popitem(last=False)
+        self._bytes -= len(evicted)
+        self.evictions += 1
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    with self._lock:
+      return {
+          'entries': len(self._entries),
+          'bytes': self._bytes,
+          'max_bytes': self.max_bytes,
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+          'expirations': self.expirations,
+      }
+
+
+class MetadataCache(object):
+  """A thread-safe cache of parsed set and reference metadata.
+
+  Values are copied on the way in and out, so callers are free to modify
+  what they get back. Entries expire after a fixed TTL, and when the cache
+  is full the entries closest to expiring are dropped first.
+  """
+
+  def __init__(self, ttl, max_entries):
+    self.ttl = ttl
+    self.max_entries = max_entries
+
+    self._lock = threading.Lock()
+    self._entries = collections.OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None or entry[0] < time.time():
+        self.misses += 1
+        return None
+      self.hits += 1
+      value = entry[1]
+    return copy.deepcopy(value)
+
+  def put(self, key, value):
+    value = copy.deepcopy(value)
+    with self._lock:
+      # Re-insert so the entries stay in expiry order
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + self.ttl, value)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    with self._lock:
+      return {
+          'entries': len(self._entries),
+          'hits': self.hits,
+          'misses': self.misses,
+      }
+
+
+class SingleFlight(object):
+  """Coalesces concurrent calls for the same key into one.
+
+  The first caller for a key makes the call. Callers arriving while it is
+  in flight wait for it and get the same result, or the same exception.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+
+    self.calls = 0
+    self.coalesced = 0
+
+  def do(self, key, func):
+    with self._lock:
+      call = self._calls.get(key)
+      if call is None:
+        call = self._calls[key] = _Call()
+        self.calls += 1
+        leader = True
+      else:
+        self.coalesced += 1
+        leader = False
+
+    if not leader:
+      call.done.wait()
+      if call.error:
+        raise call.error[0], call.error[1], call.error[2]
+      return call.result
+
+    try:
+      call.result = func()
+    except:
+      call.error = sys.exc_info()
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+    return call.result
+
+  def stats(self):
+    with self._lock:
+      return {
+          'in_flight': len(self._calls),
+          'calls': self.calls,
+          'coalesced': self.coalesced,
+      }
+
+
+class _Call(object):
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
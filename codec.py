@@ -0,0 +1,176 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+JSON encoding and decoding for API requests and responses.
+
+loads and dumps use the fastest JSON library that is installed, picked at
+import, and fall back to the standard library's json:
+
+  decoding  ujson, then simplejson (with its C speedups), then json
+  encoding  simplejson (with its C speedups), then json
+
+An encoder is only used if it writes exactly what json.dumps does for a
+sample of API data, so responses stay byte-for-byte the same whichever
+library is in use. (ujson can't: it writes no spaces after separators.)
+
+Running this file compares the libraries on a page of reads:
+
+  python codec.py
+"""
+
+import json
+import sys
+import time
+
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
+try:
+  import simplejson
+except ImportError:
+  simplejson = None
+
+
+def _has_speedups(module):
+  # Without its C extension simplejson is slower than the standard library
+  return (getattr(module.encoder, 'c_make_encoder', None) is not None and
+          getattr(module.scanner, 'c_make_scanner', None) is not None)
+
+
+# (name, function) in order of preference
+DECODERS = []
+ENCODERS = []
+if ujson is not None:
+  DECODERS.append(('ujson', lambda s: ujson.loads(s, precise_float=True)))
+if simplejson is not None and _has_speedups(simplejson):
+  DECODERS.append(('simplejson', simplejson.loads))
+  ENCODERS.append(('simplejson', simplejson.dumps))
+DECODERS.append(('json', json.loads))
+ENCODERS.append(('json', json.dumps))
+
+# Values of the kinds found in API responses
+_SAMPLE = {
+    'id': u'CJDmkYn8ChCh3p\u00e9T8',
+    'nextPageToken': None,
+    'alignments': [{
+        'alignedSequence': 'ACGTN' * 4,
+        'alignedQuality': [30, 0, 41, 2],
+        'alignment': {
+            'position': {'referenceName': '1', 'position': '12345',
+                         'reverseStrand': True},
+            'cigar': [{'operation': 'ALIGNMENT_MATCH',
+                       'operationLength': '100'}],
+            'mappingQuality': 60,
+        },
+        'info': {'AF': [0.25, 1e-07, 3.0], 'NM': ['1'], 'XT': []},
+        'fragmentName': 'read/1 "quoted"\t\\\n</script>',
+        'improperPlacement': False,
+        'numberReads': 2,
+    }],
+    'alleleFrequency': 0.1 + 0.2,
+    'count': 2 ** 40,
+}
+
+
+def _encodes_like_json(dumps):
+  try:
+    return dumps(_SAMPLE) == json.dumps(_SAMPLE)
+  except Exception:
+    return False
+
+
+DECODER, _loads = DECODERS[0]
+ENCODER, _dumps = [encoder for encoder in ENCODERS
+                   if _encodes_like_json(encoder[1])][0]
+
+
+def loads(s):
+  """Decode JSON text, as json.loads does"""
+  if _loads is json.loads:
+    return json.loads(s)
+  try:
+    return _loads(s)
+  except (ValueError, OverflowError):
+    # Let json raise its own error, or decode what the faster library can't
+    # (like integers beyond 64 bits)
+    return json.loads(s)
+
+
+def dumps(obj):
+  """Encode a value as JSON text, exactly as json.dumps does"""
+  return _dumps(obj)
+
+
+def make_reads_page(count=1024, length=100):
+  """Return a search response with count reads, for benchmarking"""
+  alignments = []
+  for i in xrange(count):
+    alignments.append({
+        'id': 'CJDmkYn8ChCh3pi-6__RARIGd2F0c29uGAEg%d' % i,
+        'readGroupId': 'CJDmkYn8ChCh3pi-6__RARIGd2F0c29uGAEgrQ',
+        'fragmentName': 'HWI-ST1234:8:1101:%d:%d' % (i, i * 7),
+        'properPlacement': True,
+        'fragmentLength': 312,
+        'readNumber': i % 2,
+        'numberReads': 2,
+        'alignedSequence': ('ACGT' * length)[i % 4:i % 4 + length],
+        'alignedQuality': [(i + j) % 41 for j in xrange(length)],
+        'alignment': {
+            'position': {'referenceName': '17', 'position': str(41196311 + i),
+                         'reverseStrand': bool(i % 2)},
+            'mappingQuality': 60,
+            'cigar': [{'operation': 'ALIGNMENT_MATCH',
+                       'operationLength': str(length)}],
+        },
+        'nextMatePosition': {'referenceName': '17',
+                             'position': str(41196511 + i),
+                             'reverseStrand': not i % 2},
+        'info': {'NM': ['0'], 'MD': [str(length)], 'AS': [str(length)]},
+    })
+  return {'alignments': alignments, 'nextPageToken': 'CJDmkYn8ChCh3pi'}
+
+
+def _time(func, arg, repeat):
+  best = None
+  for _ in xrange(repeat):
+    start_time = time.time()
+    func(arg)
+    elapsed = time.time() - start_time
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+
+def main(argv):
+  repeat = int(argv[1]) if len(argv) > 1 else 20
+  page = make_reads_page()
+  text = json.dumps(page)
+  print 'Reads page: %d alignments, %d bytes' % (
+      len(page['alignments']), len(text))
+  print 'Using %s to decode and %s to encode' % (DECODER, ENCODER)
+  print
+  print '%-12s %-8s %10s %10s' % ('library', '', 'ms', 'MB/s')
+  for operation, functions, arg in (('loads', DECODERS, text),
+                                    ('dumps', ENCODERS, page)):
+    for name, function in functions:
+      elapsed = _time(function, arg, repeat)
+      print '%-12s %-8s %10.2f %10.1f' % (
+          name, operation, elapsed * 1000, len(text) / elapsed / 1e6)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
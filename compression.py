@@ -0,0 +1,217 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compression of API responses.
+
+CompressionMiddleware compresses responses with gzip, deflate or (if the
+brotli module is installed) brotli, whichever the client's Accept-Encoding
+prefers. Responses smaller than a threshold are sent as they are, since
+compressing them saves little and costs a round of CPU on both ends.
+
+Streamed responses (a handler's app_iter) are compressed as they go: each
+chunk is compressed and flushed on its own, so clients can decode every
+chunk as soon as it arrives rather than waiting for the whole stream.
+"""
+
+import zlib
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# Responses smaller than this many bytes are not compressed
+MIN_SIZE = 1024
+
+COMPRESSION_LEVEL = 6
+
+# Content types which are worth compressing
+COMPRESSIBLE_TYPES = frozenset([
+    'application/json',
+    'application/x-ndjson',
+    'application/x-gabrowse-reads',
+    'application/javascript',
+    'text/plain',
+    'text/html',
+    'text/css',
+])
+
+# The encodings we can produce, in order of preference when the client
+# accepts several equally
+ENCODINGS = (['br'] if brotli is not None else []) + ['gzip', 'deflate']
+
+
+def choose_encoding(accept_encoding):
+  """Return the best encoding for an Accept-Encoding header, or None"""
+  qualities = {}
+  for part in accept_encoding.split(','):
+    fields = part.strip().split(';')
+    coding = fields[0].strip().lower()
+    if not coding:
+      continue
+    quality = 1.0
+    for param in fields[1:]:
+      name, _, value = param.strip().partition('=')
+      if name.strip().lower() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    qualities[coding] = quality
+
+  best, best_quality = None, 0.0
+  for encoding in ENCODINGS:
+    quality = qualities.get(encoding, qualities.get('*', 0.0))
+    if quality > best_quality:
+      best, best_quality = encoding, quality
+  return best
+
+
+class _Compressor(object):
+  """Incremental compression with a zlib-like compress/flush interface"""
+
+  def __init__(self, encoding, level):
+    self._brotli = None
+    self._zlib = None
+    if encoding == 'br':
+      self._brotli = brotli.Compressor()
+    else:
+      # 16 + MAX_WBITS writes a gzip header and trailer; deflate is the
+      # zlib format, which is what browsers expect for "deflate"
+      wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+      self._zlib = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+  def compress(self, data):
+    if self._brotli:
+      return self._brotli.process(data)
+    return self._zlib.compress(data)
+
+  def flush(self):
+    """Return everything compressed so far, keeping the stream open"""
+    if self._brotli:
+      return self._brotli.flush()
+    return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+  def finish(self):
+    if self._brotli:
+      return self._brotli.finish()
+    return self._zlib.flush(zlib.Z_FINISH)
+
+
+def _iter_compressed(first, rest, compressor, close):
+  try:
+    yield compressor.compress(first) + compressor.flush()
+    for chunk in rest:
+      if chunk:
+        yield compressor.compress(chunk) + compressor.flush()
+    yield compressor.finish()
+  finally:
+    if close:
+      close()
+
+
+class CompressionMiddleware(object):
+  """A WSGI middleware compressing responses under a path prefix"""
+
+  def __init__(self, app, path_prefix='/', min_size=MIN_SIZE,
+               level=COMPRESSION_LEVEL):
+    self.app = app
+    self.path_prefix = path_prefix
+    self.min_size = min_size
+    self.level = level
+
+  def __call__(self, environ, start_response):
+    if (not environ.get('PATH_INFO', '').startswith(self.path_prefix) or
+        environ['REQUEST_METHOD'] == 'HEAD'):
+      return self.app(environ, start_response)
+    encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+
+    # Hold on to the response start until we've seen enough of the body to
+    # decide whether to compress it
+    started = []
+    def start(status, headers, exc_info=None):
+      started[:] = [status, headers, exc_info]
+      return lambda data: pending.append(data)
+
+    pending = []
+    result = self.app(environ, start)
+    try:
+      if isinstance(result, (list, tuple)):
+        # The whole body is already here
+        pending.extend(result)
+        chunks = None
+      else:
+        chunks = iter(result)
+        size = 0
+        for chunk in chunks:
+          pending.append(chunk)
+          size += len(chunk)
+          if size >= self.min_size:
+            break
+        else:
+          chunks = None
+    except:
+      if hasattr(result, 'close'):
+        result.close()
+      raise
+    first = ''.join(pending)
+    status, headers, exc_info = started
+
+    names = dict((name.lower(), value) for name, value in headers)
+    content_type = names.get('content-type', '').split(';')[0].strip()
+    compressible = (content_type.lower() in COMPRESSIBLE_TYPES and
+                    'content-encoding' not in names and
+                    status.startswith('200'))
+    if compressible:
+      headers = [(name, value) for name, value in headers
+                 if name.lower() != 'vary'] + [
+                     ('Vary', ', '.join(filter(None, [
+                         names.get('vary'), 'Accept-Encoding'])))]
+
+    close = getattr(result, 'close', None)
+    if (not compressible or not encoding or
+        (chunks is None and len(first) < self.min_size)):
+      start_response(status, headers, exc_info)
+      if chunks is None:
+        if close:
+          close()
+        return [first]
+      return _iter_rest(first, chunks, close)
+
+    headers = [(name, value) for name, value in headers
+               if name.lower() != 'content-length']
+    headers.append(('Content-Encoding', encoding))
+    compressor = _Compressor(encoding, self.level)
+    if chunks is None:
+      # The whole body is here, so compress it in one go
+      if close:
+        close()
+      body = compressor.compress(first) + compressor.finish()
+      headers.append(('Content-Length', str(len(body))))
+      start_response(status, headers, exc_info)
+      return [body]
+
+    start_response(status, headers, exc_info)
+    return _iter_compressed(first, chunks, compressor, close)
+
+
+def _iter_rest(first, rest, close):
+  try:
+    yield first
+    for chunk in rest:
+      yield chunk
+  finally:
+    if close:
+      close()
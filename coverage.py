@@ -0,0 +1,177 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Binned read depth over a genomic window.
+
+Depth is the mean number of aligned bases covering each position of a bin.
+It can be computed from reads (accumulated with NumPy when it is available)
+or resampled from precomputed coverage buckets.
+"""
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# CIGAR operations which align read bases to the reference
+ALIGNED_OPERATIONS = frozenset([
+    'ALIGNMENT_MATCH', 'SEQUENCE_MATCH', 'SEQUENCE_MISMATCH'
+])
+
+# CIGAR operations which consume read bases, and reference bases
+READ_OPERATIONS = ALIGNED_OPERATIONS | frozenset(['INSERT', 'CLIP_SOFT'])
+REFERENCE_OPERATIONS = ALIGNED_OPERATIONS | frozenset(['DELETE', 'SKIP'])
+
+COUNTED_BASES = 'ACGT'
+
+
+def get_bin_count(start, end, bin_size):
+  return (end - start + bin_size - 1) // bin_size
+
+
+def get_aligned_blocks(read):
+  """Yield (reference start, read offset, length) for each aligned block"""
+  alignment = read.get('alignment') or {}
+  if 'position' not in alignment:
+    return
+
+  position = int(alignment['position'].get('position', 0))
+  offset = 0
+  for op in alignment.get('cigar', []):
+    operation = op.get('operation')
+    length = int(op.get('operationLength', 0))
+    if operation in ALIGNED_OPERATIONS:
+      yield position, offset, length
+    if operation in REFERENCE_OPERATIONS:
+      position += length
+    if operation in READ_OPERATIONS:
+      offset += length
+
+
+def _bases_before(edges, bounds):
+  # For each bound, the sum over edges of max(0, bound - edge)
+  edges = numpy.sort(edges)
+  totals = numpy.concatenate(([0], numpy.cumsum(edges)))
+  counts = numpy.searchsorted(edges, bounds)
+  return bounds * counts - totals[counts]
+
+
+def _bin_means(block_starts, block_ends, start, end, bin_size):
+  # The aligned bases before each bin boundary are the bases past the block
+  # starts less those past the block ends, so each bin's total is the
+  # difference between its boundaries. This takes memory per bin and per
+  # block, never per base, however big the window.
+  bin_count = get_bin_count(start, end, bin_size)
+  bounds = numpy.minimum(numpy.arange(bin_count + 1) * bin_size, end - start)
+  bases = (_bases_before(block_starts, bounds) -
+           _bases_before(block_ends, bounds))
+  return (numpy.diff(bases) / numpy.diff(bounds).astype(float)).tolist()
+
+
+def from_reads(reads, start, end, bin_size, count_bases=False):
+  """Compute binned depth (and optionally base counts) from aligned reads.
+
+  Returns (depth, counts) where depth is a list with the mean depth of each
+  bin and counts is None or a dict from each of A/C/G/T to a list of the
+  number of times that base was seen in each bin.
+  """
+  if numpy is None:
+    return _from_reads_slowly(reads, start, end, bin_size, count_bases)
+
+  window = end - start
+  block_starts = []
+  block_ends = []
+  base_positions = []
+  base_letters = []
+  for read in reads:
+    sequence = read.get('alignedSequence') if count_bases else None
+    for position, offset, length in get_aligned_blocks(read):
+      block_starts.append(position)
+      block_ends.append(position + length)
+      if sequence:
+        letters = sequence[offset:offset + length]
+        base_positions.append(
+            numpy.arange(position, position + len(letters)))
+        base_letters.append(letters)
+
+  block_starts = numpy.clip(numpy.array(block_starts, dtype=numpy.int64) -
+                            start, 0, window)
+  block_ends = numpy.clip(numpy.array(block_ends, dtype=numpy.int64) - start,
+                          0, window)
+  depth = _bin_means(block_starts, block_ends, start, end, bin_size)
+
+  counts = None
+  if count_bases:
+    bin_count = get_bin_count(start, end, bin_size)
+    counts = dict((base, [0] * bin_count) for base in COUNTED_BASES)
+    if base_positions:
+      positions = numpy.concatenate(base_positions) - start
+      letters = numpy.fromstring(
+          ''.join(base_letters).upper().encode('ascii', 'replace'), dtype='S1')
+      in_window = (positions >= 0) & (positions < window)
+      bins = positions[in_window] // bin_size
+      letters = letters[in_window]
+      for base in COUNTED_BASES:
+        counts[base] = numpy.bincount(bins[letters == base],
+                                      minlength=bin_count).tolist()
+
+  return depth, counts
+
+
+def _from_reads_slowly(reads, start, end, bin_size, count_bases):
+  bin_count = get_bin_count(start, end, bin_size)
+  totals = [0] * bin_count
+  counts = None
+  if count_bases:
+    counts = dict((base, [0] * bin_count) for base in COUNTED_BASES)
+
+  for read in reads:
+    sequence = read.get('alignedSequence') if count_bases else None
+    for position, offset, length in get_aligned_blocks(read):
+      for i in xrange(max(position, start), min(position + length, end)):
+        totals[(i - start) // bin_size] += 1
+        if sequence and offset + i - position < len(sequence):
+          base = sequence[offset + i - position].upper()
+          if base in counts:
+            counts[base][(i - start) // bin_size] += 1
+
+  depth = [float(total) / min(bin_size, end - start - i * bin_size)
+           for i, total in enumerate(totals)]
+  return depth, counts
+
+
+def from_buckets(buckets, start, end, bin_size):
+  """Resample coverage buckets to the requested bins.
+
+  Each bin gets the mean of the buckets' meanCoverage, weighted by how much
+  of the bin each bucket overlaps.
+  """
+  bin_count = get_bin_count(start, end, bin_size)
+  totals = [0.0] * bin_count
+  for bucket in buckets:
+    bucket_start = int(bucket['range'].get('start', 0))
+    bucket_end = int(bucket['range']['end'])
+    mean_coverage = float(bucket.get('meanCoverage', 0))
+
+    first = max(bucket_start, start)
+    last = min(bucket_end, end)
+    while first < last:
+      index = (first - start) // bin_size
+      bin_end = min(start + (index + 1) * bin_size, last)
+      totals[index] += mean_coverage * (bin_end - first)
+      first = bin_end
+
+  return [total / min(bin_size, end - start - i * bin_size)
+          for i, total in enumerate(totals)]
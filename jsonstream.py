@@ -0,0 +1,133 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Incremental parsing of large JSON search responses.
+
+Search responses are a JSON object holding one large array (of alignments,
+variants, ...) plus a few small members like nextPageToken. These helpers
+walk such a response one array element at a time, so the full document is
+never materialized, and can project each element down to a set of fields
+as it goes.
+"""
+
+import json
+import logging
+import re
+
+import codec
+
+# Projected elements are written out in chunks of about this many bytes
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _skip(content, index):
+  return _whitespace.match(content, index).end()
+
+
+def _expect(content, index, char):
+  if content[index:index + 1] != char:
+    raise ValueError('Expecting %r at char %d' % (char, index))
+  return _skip(content, index + 1)
+
+
+def iter_array(content, key, members):
+  """Yield the elements of the top-level array `key` one at a time.
+
+  content is the text of a JSON object. Its other top-level members are
+  decoded into the members dict as they are passed, so the dict is only
+  complete once iteration has finished.
+  """
+  try:
+    index = _expect(content, _skip(content, 0), '{')
+    while content[index] != '}':
+      name, index = _decoder.raw_decode(content, index)
+      index = _expect(content, _skip(content, index), ':')
+
+      if name == key and content[index] == '[':
+        index = _skip(content, index + 1)
+        while content[index] != ']':
+          element, index = _decoder.raw_decode(content, index)
+          yield element
+          index = _skip(content, index)
+          if content[index] == ',':
+            index = _skip(content, index + 1)
+          elif content[index] != ']':
+            raise ValueError('Expecting , delimiter at char %d' % index)
+        index += 1
+      else:
+        members[name], index = _decoder.raw_decode(content, index)
+
+      index = _skip(content, index)
+      if content[index] == ',':
+        index = _skip(content, index + 1)
+      elif content[index] != '}':
+        raise ValueError('Expecting , delimiter at char %d' % index)
+  except IndexError:
+    raise ValueError('Unexpected end of JSON content')
+
+
+def project(element, fields):
+  """Return just the given fields of a dict (as a partial response would)"""
+  return dict((field, element[field]) for field in fields if field in element)
+
+
+def load_projected(content, key, fields):
+  """Decode a JSON object, projecting the elements of array `key`"""
+  members = {}
+  elements = [project(element, fields)
+              for element in iter_array(content, key, members)]
+  members[key] = elements
+  return members
+
+
+def iter_projected(content, key, fields):
+  """Re-encode a JSON object as text chunks, projecting array `key`.
+
+  The projected elements are produced while the input is being parsed, and
+  the remaining members are written after the array. If the input turns out
+  not to be valid JSON, the output (which may be partly sent already) is
+  ended with an "error" member in place of the remaining members.
+  """
+  members = {}
+  chunk = ['{%s: [' % json.dumps(key)]
+  size = 0
+  separator = ''
+  try:
+    for element in iter_array(content, key, members):
+      text = codec.dumps(project(element, fields))
+      chunk.append(separator)
+      chunk.append(text)
+      separator = ', '
+      size += len(text)
+      if size >= CHUNK_SIZE:
+        yield ''.join(chunk)
+        chunk = []
+        size = 0
+  except ValueError, err:
+    logging.warning('Malformed JSON response: %s', err)
+    chunk.append('], "error": "Malformed JSON response"}')
+    yield ''.join(chunk)
+    return
+
+  chunk.append(']')
+  for name, value in members.iteritems():
+    if name == key:
+      continue
+    chunk.append(', %s: %s' % (json.dumps(name), json.dumps(value)))
+  chunk.append('}')
+  yield ''.join(chunk)
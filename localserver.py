@@ -14,18 +14,229 @@ See the License for the specific language governing permissions and
 limitations under the License.
 
 This file allows users to run the python client without using app engine.
+
+By default requests are served by paste's thread pool. With --engine=gevent
+the standard library is monkey patched, so that each request and each
+upstream call made while handling it runs in a greenlet rather than a
+thread. One process can then keep thousands of upstream calls in flight,
+and the concurrent fan-out in main.py runs as greenlets too. This needs
+gevent to be installed.
+
+With --workers=N, a master process listens on the port and forks N worker
+processes which accept connections from it, each with its own thread pool
+(or greenlets). Sending the master SIGHUP starts fresh workers, which load
+the code anew, and then gracefully stops the old ones: they stop accepting
+connections and finish the requests they have. SIGTERM or SIGINT stops all
+the workers gracefully, and workers which die are replaced.
 """
-from paste import httpserver
-from paste.cascade import Cascade
-from webob.static import DirectoryApp
-from main import web_app
+import argparse
+import errno
+import os
+import signal
+import socket
+import sys
+import time
+
+# Upstream connections allowed per host when serving with gevent
+GEVENT_MAX_CONNECTIONS = 200
+
+# Seconds that a stopping server waits for in-flight requests to finish
+GRACEFUL_TIMEOUT = 30
+
+# Seconds to wait before replacing a worker which died
+RESPAWN_DELAY = 1
+
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='Run GABrowse locally.')
+  parser.add_argument('--engine', choices=['paste', 'gevent'],
+                      default='paste',
+                      help='The server to run the application with.')
+  parser.add_argument('--host', default='127.0.0.1',
+                      help='The address to listen on.')
+  parser.add_argument('--port', type=int, default=8080,
+                      help='The port to listen on.')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='The number of worker processes to fork, or 0 to '
+                      'serve from this process.')
+  parser.add_argument('--threads', type=int, default=10,
+                      help='The number of request threads per process '
+                      '(paste only).')
+  return parser.parse_args()
+
+
+def make_app(engine):
+  """Route requests by path prefix, the way app.yaml does on App Engine"""
+  from paste.urlmap import URLMap
+  from webob.static import FileApp
+  import main as gabrowse
+  import staticassets
+
+  if engine == 'gevent':
+    # Greenlets are cheap enough to allow many more upstream connections
+    transports = [backend['http']
+                  for backend in gabrowse.SUPPORTED_BACKENDS.values()]
+    transports.append(gabrowse.BaseSnpediaHandler.http)
+    for transport in transports:
+      transport.max_connections = GEVENT_MAX_CONNECTIONS
+
+  static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'static')
+  app = URLMap()
+  app['/static'] = staticassets.StaticApp(static_dir)
+  app['/robots.txt'] = FileApp(os.path.join(static_dir, 'robots.txt'))
+  app['/'] = gabrowse.web_app
+  return app
+
+
+def make_listener(host, port):
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  listener.bind((host, port))
+  listener.listen(128)
+  return listener
+
+
+def make_paste_server(listener, app, threads):
+  from paste import httpserver
+
+  class Server(httpserver.WSGIThreadPoolServer):
+
+    def server_bind(self):
+      # Serve from the shared listener rather than binding a new socket
+      self.socket.close()
+      self.socket = listener
+      self.server_address = listener.getsockname()
+      host, port = self.server_address[:2]
+      self.server_name = socket.getfqdn(host)
+      self.server_port = port
+
+    def stop(self):
+      self.running = False
+
+    def serve_forever(self):
+      while self.running:
+        try:
+          self.handle_request()
+        except socket.timeout:
+          pass
+
+      # Let queued and running requests finish before the pool shuts down
+      pool = self.thread_pool
+      deadline = time.time() + GRACEFUL_TIMEOUT
+      while ((pool.queue.qsize() or pool.worker_tracker) and
+             time.time() < deadline):
+        time.sleep(0.1)
+      pool.shutdown()
+
+  return Server(app, listener.getsockname(), httpserver.WSGIHandler,
+                nworkers=threads)
+
+
+def serve(engine, listener, threads):
+  """Serve requests from the listener until SIGTERM"""
+  if engine == 'gevent':
+    # This has to happen before main.py is imported, and (so that the master
+    # doesn't have to cooperate with gevent) only once workers are forked
+    from gevent import monkey
+    monkey.patch_all()
+    listener = socket.socket(_sock=listener._sock)
+
+  app = make_app(engine)
+
+  if engine == 'gevent':
+    import gevent
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer(listener, app)
+    gevent.signal_handler(signal.SIGTERM, server.stop, GRACEFUL_TIMEOUT)
+  else:
+    server = make_paste_server(listener, app, threads)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+
+  server.serve_forever()
+
+
+def run_workers(args, listener):
+  """Keep args.workers worker processes serving until told to stop"""
+  signals = []
+  for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+    signal.signal(signum, lambda signum, frame: signals.append(signum))
+
+  def start_worker():
+    pid = os.fork()
+    if pid:
+      return pid
+
+    # The master handles reloads and interrupts
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    status = 0
+    try:
+      serve(args.engine, listener, args.threads)
+    except Exception:
+      import traceback
+      traceback.print_exc()
+      status = 1
+    finally:
+      os._exit(status)
+
+  def stop_workers(pids):
+    for pid in pids:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
+
+  workers = set(start_worker() for _ in range(args.workers))
+  stopping = set()
+  while True:
+    while signals:
+      signum = signals.pop(0)
+      if signum == signal.SIGHUP:
+        print 'reloading workers'
+        stopping |= workers
+        workers = set(start_worker() for _ in range(args.workers))
+        stop_workers(stopping)
+      else:
+        print 'stopping workers'
+        stop_workers(workers)
+        stopping |= workers
+        workers = set()
+
+    if not workers and not stopping:
+      return
+
+    try:
+      pid, _ = os.waitpid(-1, 0)
+    except OSError, err:
+      if err.errno == errno.EINTR:
+        continue
+      raise
+
+    stopping.discard(pid)
+    if pid in workers:
+      workers.discard(pid)
+      if not signals:
+        print 'worker %d died, replacing it' % pid
+        time.sleep(RESPAWN_DELAY)
+        workers.add(start_worker())
+
 
 def main():
-  static_app = DirectoryApp(".", index_page=None)
+  args = parse_args()
+  listener = make_listener(args.host, args.port)
+  print 'serving on http://%s:%d' % (args.host, args.port)
+  sys.stdout.flush()
 
-  # Create a cascade that looks for static files first, then tries the webapp
-  app = Cascade([static_app, web_app])
-  httpserver.serve(app, host='127.0.0.1', port='8080')
+  if args.workers > 0:
+    # The workers import the application themselves, so that each one
+    # starts without threads or connections left over from the master and
+    # reloads pick up new code.
+    run_workers(args, listener)
+  else:
+    serve(args.engine, listener, args.threads)
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  main()
@@ -24,16 +24,35 @@ This file serves two main purposes
 # Ensembl: 0.6.0
 # https://github.com/ga4gh/schemas/blob/v0.6.0a1/src/main/resources/avro/
 
-import json
+import base64
+import heapq
 import logging
 import os
+import random
 import re
 import socket
+import struct
 import time
+import urllib
 
 import jinja2
 import webapp2
 
+import cache
+import codec
+import compression
+import coverage
+import jsonstream
+import metrics
+import parallel
+import profiler
+import pyramid
+import readcodec
+import snpcache
+import snpindex
+import staticassets
+import tiling
+import tracing
 from references import GRCh38
 
 # Need to jump through a few small module import hoops to allow for running in
@@ -62,6 +81,9 @@ try:
 except:
   import httplib2
 
+# The upstream transport needs httplib2 too
+import transport
+
 # Set constants for which GA4GH backends to include
 INCLUDE_BACKEND_ENSEMBL = True
 INCLUDE_BACKEND_GOOGLE = True
@@ -72,11 +94,44 @@ if INCLUDE_BACKEND_GOOGLE:
 
 socket.setdefaulttimeout(60)
 
+# Upstream requests go through a pooled transport (see transport.py) with up
+# to UPSTREAM_MAX_CONNECTIONS concurrent keep-alive connections per host.
+# Requests wait up to UPSTREAM_POOL_TIMEOUT seconds for a free connection.
+UPSTREAM_MAX_CONNECTIONS = 10
+UPSTREAM_CONNECT_TIMEOUT = 10
+UPSTREAM_READ_TIMEOUT = 60
+UPSTREAM_POOL_TIMEOUT = 30
+
+
+def make_transport(make_http=httplib2.Http):
+  return transport.Transport(
+      make_http,
+      max_connections=UPSTREAM_MAX_CONNECTIONS,
+      connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+      read_timeout=UPSTREAM_READ_TIMEOUT,
+      pool_timeout=UPSTREAM_POOL_TIMEOUT,
+      # App Engine's httplib2 only has a single deadline for each request
+      split_timeouts=not IS_APP_ENGINE)
+
+# API responses of at least COMPRESSION_MIN_SIZE bytes are compressed for
+# clients which accept it (see compression.py). App Engine compresses
+# responses itself, and doesn't let applications set Content-Encoding.
+COMPRESS_RESPONSES = not IS_APP_ENGINE
+COMPRESSION_MIN_SIZE = 1024
+
 JINJA_ENVIRONMENT = jinja2.Environment(
     loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
     autoescape=True,
     extensions=['jinja2.ext.autoescape'])
 
+# Templates link to static files with static_url, which gives the
+# fingerprinted URL of a file once the static files have been built (see
+# staticassets.py), and its plain URL otherwise.
+STATIC_MANIFEST = staticassets.load_manifest(
+    os.path.join(os.path.dirname(__file__), 'static'))
+JINJA_ENVIRONMENT.globals['static_url'] = \
+    staticassets.make_static_url(STATIC_MANIFEST)
+
 
 # Supported data types
 SET_TYPE_CALLSET = 'CALLSET'
@@ -89,7 +144,7 @@ if INCLUDE_BACKEND_ENSEMBL:
   SUPPORTED_BACKENDS['Ensembl'] = {
       'name': 'Ensembl',
       'ga4gh_api_version': '0.6.0',
-      'http': httplib2.Http(timeout=60),
+      'http': make_transport(),
       'url': 'http://rest.ensembl.org/ga4gh/%s?%s',
       'datasets': {'1000 Genomes phase3': '6e340c4d1e333c7a676b1710d2e3953c'},
       'set_types' : [ SET_TYPE_CALLSET ],
@@ -105,10 +160,11 @@ if INCLUDE_BACKEND_GOOGLE:
     credentials = credentials.create_scoped(
         'https://www.googleapis.com/auth/genomics')
 
-    http = httplib2.Http()
-    http = credentials.authorize(http)
+    # Every pooled connection shares the one set of credentials
+    def make_http(timeout):
+      return credentials.authorize(httplib2.Http(timeout=timeout))
 
-    return http
+    return make_transport(make_http)
 
   SUPPORTED_BACKENDS['GOOGLE'] = {
       'name': 'Google',
@@ -116,6 +172,7 @@ if INCLUDE_BACKEND_GOOGLE:
       'http': init_google_http(),
       'url': 'https://genomics.googleapis.com/v1/%s?%s',
       'supportsPartialResponse': True,
+      'supportsCoverageBuckets': True,
       'datasets': {'1000 Genomes': '10473108253681171589',
                    'Platinum Genomes': '3049512673186936334',
                    'DREAM SMC Challenge': '337315832689',
@@ -125,12 +182,340 @@ if INCLUDE_BACKEND_GOOGLE:
   }
 
 
+# Upstream responses are cached in-process, keyed on the backend, path, body
+# and fields. Paths are matched against the TTL rules (in seconds) in order;
+# anything without a matching rule is never cached.
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_TTLS = [
+    (r'^(reads|variants)/search$', 10 * 60),
+    (r'^(readgroupsets|callsets|variantsets|references)/search$', 60 * 60),
+    (r'^(readgroupsets|callsets|variantsets)/[^/]+(/coveragebuckets)?$',
+     24 * 60 * 60),
+]
+
+RESPONSE_CACHE = cache.ResponseCache(RESPONSE_CACHE_MAX_BYTES,
+                                     RESPONSE_CACHE_TTLS)
+
+# Concurrent identical upstream requests (per RESPONSE_CACHE key) are
+# coalesced into one, whose response or error all the callers share.
+UPSTREAM_REQUESTS = cache.SingleFlight()
+
+# Set and reference metadata (the assembled response for each set, reference
+# lists, and the variant set of each call set) almost never changes. It is
+# kept apart from the response cache, where pages of reads could evict it.
+# Like the response cache, it is bypassed and refreshed with noCache=true.
+METADATA_CACHE_TTL = 7 * 24 * 60 * 60
+METADATA_CACHE = cache.MetadataCache(METADATA_CACHE_TTL, max_entries=10000)
+
+# Whether read and variant searches are split into fixed-size genomic tiles
+# (see tiling.py) by default. Clients can override this with tiled=true|false.
+TILED_SEARCH = False
+
+# Whether read searches over several read group sets query each set
+# concurrently and merge the results by position, by default. Clients can
+# override this with fanOut=true|false.
+FANOUT_SEARCH = False
+FANOUT_MAX_WORKERS = 8
+
+# Upper bounds on how much a single drain=true call to /api/reads will
+# stream back before handing the next page token to the client.
+DRAIN_MAX_READS = 50000
+DRAIN_MAX_BYTES = 64 * 1024 * 1024
+
+# Limits for /api/coverage. Windows are split into at most this many bins,
+# and computing depth from reads stops after this many pages. Per-base
+# counts are only available for bins up to the given size.
+COVERAGE_DEFAULT_BINS = 500
+COVERAGE_MAX_BINS = 10000
+COVERAGE_MAX_READ_PAGES = 20
+COVERAGE_BASE_COUNTS_MAX_BIN_SIZE = 16
+
+# Coverage is kept in a multi-resolution pyramid per read group set and
+# reference (see pyramid.py). Pyramids start from coverage buckets of the
+# given width and are refined from reads, in bins of the given size, for
+# windows up to COVERAGE_MAX_READ_WINDOW bases. Answers from a level more
+# than PYRAMID_MAX_COARSENING times coarser than asked for are only used if
+# the window is too big to compute from reads. Outside of App Engine the
+# pyramids are also saved to disk so that they survive restarts.
+PYRAMID_BUCKET_WIDTH = 16384
+PYRAMID_REFINED_BIN_SIZE = 16
+PYRAMID_MAX_COARSENING = 4
+COVERAGE_MAX_READ_WINDOW = 200000
+COVERAGE_PYRAMID_DIR = None if IS_APP_ENGINE else \
+    os.path.join(os.path.dirname(__file__), 'cache', 'pyramids')
+
+COVERAGE_PYRAMIDS = pyramid.PyramidStore(COVERAGE_PYRAMID_DIR)
+
+# SNPedia pages rarely change, so outside of App Engine they are cached in a
+# SQLite database. Pages that don't exist are cached for less time, and the
+# least recently used pages are evicted once the content passes the cap.
+SNPEDIA_CACHE_PATH = None if IS_APP_ENGINE or snpcache.sqlite3 is None else \
+    os.path.join(os.path.dirname(__file__), 'cache', 'snpedia.sqlite')
+SNPEDIA_CACHE_TTL = 30 * 24 * 60 * 60
+SNPEDIA_CACHE_MISSING_TTL = 24 * 60 * 60
+SNPEDIA_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# SNP searches are answered from an offline index (see snpindex.py) when one
+# has been built, falling back to SNPedia for anything it doesn't have.
+SNP_INDEX_PATH = os.path.join(os.path.dirname(__file__), 'snpindex.bin')
+
+
+def load_snp_index(path):
+  if not os.path.exists(path):
+    return None
+  try:
+    return snpindex.SnpIndex.load(path)
+  except (IOError, ValueError, struct.error), err:
+    logging.warning('Ignoring unreadable SNP index %s: %s', path, err)
+    return None
+
+SNP_INDEX = load_snp_index(SNP_INDEX_PATH)
+
+# SNPedia pages are looked up in batches of up to SNPEDIA_MAX_TITLES titles
+# (the MediaWiki limit), with up to SNPEDIA_MAX_WORKERS batches at a time.
+# Gene searches return whatever SNPs were resolved within the time budget.
+SNPEDIA_MAX_TITLES = 50
+SNPEDIA_MAX_WORKERS = 4
+SNPEDIA_TIME_BUDGET = 20
+
+# The most genotypes that can be looked up in one bulk /api/alleles call
+SNPEDIA_MAX_GENOTYPES = 100
+
+SNPEDIA_CACHE = snpcache.PageCache(
+    SNPEDIA_CACHE_PATH, SNPEDIA_CACHE_TTL, SNPEDIA_CACHE_MISSING_TTL,
+    SNPEDIA_CACHE_MAX_BYTES) if SNPEDIA_CACHE_PATH else None
+
+# Request, upstream and cache metrics, served at /api/metrics in the
+# Prometheus text format (see metrics.py). Upstream paths are labelled with
+# their IDs replaced, like callsets/{id}.
+METRICS = metrics.Registry()
+API_LATENCY = METRICS.histogram(
+    'gabrowse_api_request_seconds',
+    'Wall-clock time to handle API requests, including streaming responses',
+    ['route', 'backend'])
+API_RESPONSES = METRICS.counter(
+    'gabrowse_api_responses_total', 'API responses by HTTP status',
+    ['route', 'backend', 'status'])
+API_RESPONSE_BYTES = METRICS.histogram(
+    'gabrowse_api_response_bytes',
+    'Sizes of API response bodies in bytes, before compression',
+    ['route', 'backend'], buckets=metrics.SIZE_BUCKETS)
+API_UPSTREAM_PAGES = METRICS.histogram(
+    'gabrowse_api_upstream_pages',
+    'Upstream responses (cached or not) used per API request, like the '
+    'pages of reads behind each /api/reads call',
+    ['route', 'backend', 'path'], buckets=metrics.COUNT_BUCKETS)
+UPSTREAM_LATENCY = METRICS.histogram(
+    'gabrowse_upstream_request_seconds',
+    'Wall-clock time of upstream API requests',
+    ['backend', 'path'])
+UPSTREAM_RESPONSES = METRICS.counter(
+    'gabrowse_upstream_responses_total',
+    'Upstream API responses by HTTP status ("error" if none was received)',
+    ['backend', 'path', 'status'])
+UPSTREAM_RESPONSE_BYTES = METRICS.counter(
+    'gabrowse_upstream_response_bytes_total',
+    'Bytes of upstream API response bodies, after decompression',
+    ['backend', 'path'])
+
+# Each API request is traced (see tracing.py) and its stage timings logged.
+# Requests which take at least SLOW_REQUEST_SECONDS also have every span
+# logged, to the tracing.slow logger; None turns this off.
+SLOW_REQUEST_SECONDS = 4
+
+# A fraction PROFILE_SAMPLE_RATE of API requests are profiled (see
+# profiler.py) in PROFILE_MODE, 'cprofile' or 'sample', and the results per
+# route are served from /admin/profile. On App Engine that is for
+# administrators only (see app.yaml); elsewhere it only answers requests
+# from this machine. With PROFILE_ALLOW_HEADER, requests from this machine
+# can also ask to be profiled with an X-Profile header of 1 or a mode.
+PROFILE_SAMPLE_RATE = 0
+PROFILE_MODE = 'cprofile' if IS_APP_ENGINE else 'sample'
+PROFILE_ALLOW_HEADER = False
+PROFILER = profiler.Profiler()
+
+
+def is_local_request(request):
+  """Return whether a request came from this machine"""
+  return request.remote_addr in ('127.0.0.1', '::1')
+
+
+def get_metrics_path(path):
+  """Return an upstream API path with its IDs replaced, for a metric label"""
+  parts = path.split('/')
+  if len(parts) > 1 and parts[1] != 'search':
+    parts[1] = '{id}'
+  return '/'.join(parts)
+
+
+def record_upstream_request(backend, path, start_time, status, size=0):
+  labels = (backend, get_metrics_path(path))
+  UPSTREAM_LATENCY.observe(time.time() - start_time, labels)
+  UPSTREAM_RESPONSES.inc(labels + (str(status),))
+  UPSTREAM_RESPONSE_BYTES.inc(labels, size)
+
+
+# The stats kept by caches and transports, reported by collect_stats
+CACHE_STATS = [
+    ('hits', 'counter', 'Cache lookups which found an entry'),
+    ('misses', 'counter', 'Cache lookups which found no (live) entry'),
+    ('loads', 'counter', 'Cache entries loaded from disk'),
+    ('evictions', 'counter', 'Cache entries evicted to make room'),
+    ('expirations', 'counter', 'Cache entries found to have expired'),
+    ('entries', 'gauge', 'Entries in the cache'),
+    ('bytes', 'gauge', 'Bytes held by the cache'),
+]
+TRANSPORT_STATS = [
+    ('requests', 'counter', 'Upstream requests made through the pool'),
+    ('created', 'counter', 'Upstream connections opened'),
+    ('reused', 'counter', 'Upstream requests which reused an idle connection'),
+    ('waits', 'counter', 'Upstream requests which waited for a connection'),
+    ('wait_seconds', 'counter', 'Time spent waiting for a connection'),
+    ('timeouts', 'counter', 'Upstream requests which gave up waiting'),
+    ('errors', 'counter', 'Upstream requests which failed'),
+    ('in_use', 'gauge', 'Upstream connections in use'),
+    ('idle', 'gauge', 'Idle upstream connections'),
+]
+
+
+def collect_stats():
+  caches = [('response', RESPONSE_CACHE), ('metadata', METADATA_CACHE),
+            ('coverage_pyramid', COVERAGE_PYRAMIDS)]
+  if SNPEDIA_CACHE:
+    caches.append(('snpedia', SNPEDIA_CACHE))
+  transports = [(name, backend['http'])
+                for name, backend in SUPPORTED_BACKENDS.iteritems()]
+  transports.append(('SNPedia', BaseSnpediaHandler.http))
+
+  families = []
+  def add(prefix, stat, type, help, labels, sources):
+    samples = [(source_labels, values[stat])
+               for source_labels, values in sources if stat in values]
+    if samples:
+      name = '%s_%s%s' % (prefix, stat, '_total' if type == 'counter' else '')
+      families.append((name, type, help, labels, samples))
+
+  cache_stats = [((name, ), c.stats()) for name, c in caches]
+  for stat, type, help in CACHE_STATS:
+    add('gabrowse_cache', stat, type, help, ['cache'], cache_stats)
+
+  transport_stats = [((name, host), values)
+                     for name, t in transports
+                     for host, values in t.stats().iteritems()]
+  for stat, type, help in TRANSPORT_STATS:
+    add('gabrowse_upstream_pool', stat, type, help, ['backend', 'host'],
+        transport_stats)
+
+  single_flight = UPSTREAM_REQUESTS.stats()
+  families.append((
+      'gabrowse_upstream_coalesced_total', 'counter',
+      'Upstream requests which shared an identical one already in flight',
+      [], [((), single_flight['coalesced'])]))
+  families.append((
+      'gabrowse_upstream_in_flight', 'gauge',
+      'Distinct upstream requests in flight', [],
+      [((), single_flight['in_flight'])]))
+  return families
+
+METRICS.add_collector(collect_stats)
+
+
 class ApiException(Exception):
   pass
 
 
+def looks_like_json(content_type, content):
+  """Cheaply check whether a response body is a JSON object"""
+  if 'json' not in content_type:
+    return False
+  stripped = content.strip()
+  return stripped[:1] == '{' and stripped[-1:] == '}'
+
+
 # Request handlers
-class BaseRequestHandler(webapp2.RequestHandler):
+class InstrumentedRequestHandler(webapp2.RequestHandler):
+  """Records the metrics and the trace of each API request"""
+
+  def get_metrics_backend(self):
+    backend = self.request.get('backend')
+    return backend if backend in SUPPORTED_BACKENDS else ''
+
+  def get_profile_mode(self):
+    if PROFILE_ALLOW_HEADER and is_local_request(self.request):
+      header = self.request.headers.get('X-Profile', '').lower()
+      if header in profiler.MODES:
+        return header
+      if header in ('1', 'true'):
+        return PROFILE_MODE
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+      return PROFILE_MODE
+    return None
+
+  def dispatch(self):
+    self.trace = tracing.Trace(
+        tracing.get_request_id(self.request.headers.get(tracing.HEADER)),
+        self.request.path)
+    self.response.headers[tracing.HEADER] = self.trace.request_id
+    self.profile = PROFILER.start(self.request.path, self.get_profile_mode())
+    # The upstream path of each response used, appended to from any thread
+    self.upstream_pages = []
+    try:
+      with self.trace.span('handler'), self.profile:
+        webapp2.RequestHandler.dispatch(self)
+    except webapp2.HTTPException, err:
+      # Raised by abort(), and answered with its own status
+      self.response.set_status(err.code)
+      raise
+    except:
+      # Handlers without handle_exception let it through to webapp2, which
+      # answers with a 500
+      self.response.set_status(500)
+      raise
+    finally:
+      app_iter = self.response.app_iter
+      if isinstance(app_iter, (list, tuple)):
+        self.record_request(sum(map(len, app_iter)))
+      else:
+        # Streamed responses are timed (and profiled) until the last chunk
+        # is written
+        self.response.app_iter = self.iter_recorded(app_iter)
+
+  def iter_recorded(self, chunks):
+    size = 0
+    chunks = iter(chunks)
+    try:
+      with self.trace.span('stream'):
+        while True:
+          with self.profile:
+            chunk = next(chunks, None)
+          if chunk is None:
+            break
+          size += len(chunk)
+          yield chunk
+    finally:
+      self.record_request(size)
+
+  def record_request(self, size):
+    self.trace.finish()
+    self.profile.finish()
+    backend = self.get_metrics_backend()
+    status = self.response.status_int
+    labels = (self.request.path, backend)
+    API_LATENCY.observe(self.trace.end - self.trace.start, labels)
+    API_RESPONSES.inc(labels + (str(status),))
+    API_RESPONSE_BYTES.observe(size, labels)
+
+    pages = {}
+    for path in self.upstream_pages:
+      pages[path] = pages.get(path, 0) + 1
+    for path, count in pages.iteritems():
+      API_UPSTREAM_PAGES.observe(count, labels + (path,))
+
+    self.trace.log(SLOW_REQUEST_SECONDS, backend=backend, status=status,
+                   bytes=size, query=self.request.query_string)
+
+
+class BaseRequestHandler(InstrumentedRequestHandler):
 
   def handle_exception(self, exception, debug_mode):
     if isinstance(exception, ApiException):
@@ -157,6 +542,10 @@ class BaseRequestHandler(webapp2.RequestHandler):
     return SUPPORTED_BACKENDS[self.get_backend()]\
       .has_key('supportsPartialResponse')
 
+  def supports_coverage_buckets(self):
+    return SUPPORTED_BACKENDS[self.get_backend()]\
+      .has_key('supportsCoverageBuckets')
+
   def get_base_api_url(self):
     return SUPPORTED_BACKENDS[self.get_backend()]['url']
 
@@ -169,29 +558,82 @@ class BaseRequestHandler(webapp2.RequestHandler):
   def get_set_types(self):
     return SUPPORTED_BACKENDS[self.get_backend()]['set_types']
 
-  def get_content(self, path, method='POST', body=None, params=''):
+  def use_cache(self):
+    # Clients can pass noCache=true to force a fresh upstream request
+    # (the fresh response still replaces whatever was cached).
+    return self.request.get('noCache').lower() not in ('1', 'true')
+
+  def get_metadata(self, kind, key, load):
+    """Return cached metadata, calling load() to fetch it if need be"""
+    cache_key = (self.get_backend(), kind, key)
+    if self.use_cache():
+      value = METADATA_CACHE.get(cache_key)
+      if value is not None:
+        return value
+
+    value = load()
+    METADATA_CACHE.put(cache_key, value)
+    return value
+
+  def put_metadata(self, kind, key, value):
+    METADATA_CACHE.put((self.get_backend(), kind, key), value)
+
+  def use_tiles(self):
+    tiled = self.request.get('tiled').lower()
+    if tiled:
+      return tiled in ('1', 'true')
+    return TILED_SEARCH
+
+  def get_raw_content(self, path, method='POST', body=None, params=''):
     uri = self.get_base_api_url() % (path, params)
-    start_time = time.clock()
+    key = cache.make_key(self.get_backend(), method, path, body, params)
+
+    metrics_path = get_metrics_path(path)
+    self.upstream_pages.append(metrics_path)
+    with self.trace.span('get_content', path=metrics_path) as span:
+      if self.use_cache():
+        content = RESPONSE_CACHE.get(key)
+        if content is not None:
+          span['cached'] = True
+          logging.info('[%s] get_content %s: %sb (cached)',
+                       self.trace.request_id, uri, len(content))
+          return content
+
+      # Identical requests already in flight are shared rather than repeated
+      return UPSTREAM_REQUESTS.do(
+          key, lambda: self.fetch_raw_content(uri, key, path, method, body))
+
+  def fetch_raw_content(self, uri, key, path, method, body):
+    start_time = time.time()
 
     http = self.get_http()
+    backend = self.get_backend()
 
-    try:
-      response, content = http.request(
-          uri,
-          method=method, body=json.dumps(body) if body else None,
-          headers={'Content-Type': 'application/json; charset=UTF-8'})
-    except Exception, err:
-      logging.error('%s', err)
-      raise
-
-    try:
-      content = json.loads(content)
-    except ValueError:
-      logging.error('while requesting %s', uri)
-      logging.error('non-json api content %s', content[:1000])
-      raise ApiException('The API returned invalid JSON')
+    with self.trace.span('upstream', path=get_metrics_path(path)) as span:
+      try:
+        response, content = http.request(
+            uri,
+            method=method, body=codec.dumps(body) if body else None,
+            headers={'Content-Type': 'application/json; charset=UTF-8',
+                     # httplib2 decompresses the response for us
+                     'Accept-Encoding': 'gzip, deflate'})
+      except Exception, err:
+        logging.error('%s', err)
+        record_upstream_request(backend, path, start_time, 'error')
+        raise
+      span['status'] = response.status
+      span['bytes'] = len(content)
+    record_upstream_request(backend, path, start_time, response.status,
+                            len(content))
 
     if response.status >= 300:
+      try:
+        content = codec.loads(content)
+      except ValueError:
+        logging.error('while requesting %s', uri)
+        logging.error('non-json api content %s', content[:1000])
+        raise ApiException('The API returned invalid JSON')
+
       logging.error('%s FAILED', uri)
       logging.error('error api response %s', response)
       logging.error('error api content %s', content)
@@ -203,17 +645,94 @@ class BaseRequestHandler(webapp2.RequestHandler):
       else:
         raise ApiException('Something went wrong with the API call!')
 
-    logging.info('get_content %s: %sb %ss',
-                 uri, len(content), time.clock() - start_time)
+    logging.info('[%s] get_content %s: %sb %ss', self.trace.request_id,
+                 uri, len(content), time.time() - start_time)
 
+    # Successful responses are usually passed on without being parsed, so
+    # only do a cheap sanity check here. Anything that doesn't look right
+    # gets fully parsed to decide whether it's really JSON.
+    if not looks_like_json(response.get('content-type', ''), content):
+      try:
+        codec.loads(content)
+      except ValueError:
+        logging.error('while requesting %s', uri)
+        logging.error('non-json api content %s', content[:1000])
+        raise ApiException('The API returned invalid JSON')
+
+    RESPONSE_CACHE.put(key, path, content)
     return content
 
+  def get_content(self, path, method='POST', body=None, params=''):
+    content = self.get_raw_content(path, method, body, params)
+
+    try:
+      with self.trace.span('parse', path=get_metrics_path(path)):
+        return codec.loads(content)
+    except ValueError:
+      logging.error('while requesting %s', path)
+      logging.error('non-json api content %s', content[:1000])
+      raise ApiException('The API returned invalid JSON')
+
+  def get_tiled_content(self, search, key, get_range, body, page_token=None):
+    # Rather than searching the requested window directly, search the tiles
+    # covering it one page at a time, so that the upstream requests line up
+    # between nearby windows. The page token tracks the current tile along
+    # with the upstream page token within it.
+    start, end = body['start'], body['end']
+    tiles = tiling.get_tiles(start, end)
+    tile_starts = [tile_start for tile_start, _ in tiles]
+
+    tile_index, tile_token = 0, None
+    if page_token:
+      tile_start, tile_token = tiling.decode_page_token(page_token)
+      if tile_start not in tile_starts:
+        raise ApiException('Invalid page token')
+      tile_index = tile_starts.index(tile_start)
+
+    while True:
+      tile_start, tile_end = tiles[tile_index]
+      tile_body = dict(body, start=tile_start, end=tile_end)
+      if tile_token:
+        tile_body['pageToken'] = tile_token
+
+      content = search(tile_body)
+      with self.trace.span('filter', trim=key):
+        content[key] = tiling.trim(content.get(key, []), get_range, start, end,
+                                   tile_start if tile_index else None)
+
+      tile_token = content.pop('nextPageToken', None)
+      if not tile_token:
+        tile_index += 1
+        if tile_index == len(tiles):
+          return content
+
+      content['nextPageToken'] = tiling.encode_page_token(
+          tiles[tile_index][0], tile_token)
+
+      # Don't bother the client with pages that were trimmed to nothing
+      if content[key]:
+        return content
+
   def write_response(self, content):
     self.response.headers['Content-Type'] = 'application/json'
-    self.response.write(json.dumps(content))
+    with self.trace.span('serialize'):
+      self.response.write(codec.dumps(content))
+
+  def write_raw_response(self, content):
+    # The content is already JSON text (see get_raw_content), so there is
+    # no need to parse and re-serialize it.
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(content)
+
+  def write_stream(self, chunks, content_type='application/x-ndjson'):
+    # Stream the response (newline-delimited JSON by default); the chunks are
+    # generated as the response is written out, after the handler has
+    # returned.
+    self.response.headers['Content-Type'] = content_type
+    self.response.app_iter = chunks
 
   def write_content(self, path, method='POST', body=None, params=''):
-    self.write_response(self.get_content(path, method, body, params))
+    self.write_raw_response(self.get_raw_content(path, method, body, params))
 
 
 class SetSearchHandler(BaseRequestHandler):
@@ -251,49 +770,103 @@ class SetSearchHandler(BaseRequestHandler):
 
     if ga4gh_api_version == '0.6.0':
       # Single variantset ID as input
-      self.write_content('callsets/search',
-                         body={'variantSetId': variant_set_id,
-                               'name': name,
-                               'pageSize': 100},
-                         params='fields=callSets(id,name)')
+      call_sets = self.get_content('callsets/search',
+                                   body={'variantSetId': variant_set_id,
+                                         'name': name,
+                                         'pageSize': 100},
+                                   params='fields=callSets(id,name)')
     elif ga4gh_api_version == '0.5.1':
       # Array of variantset IDs as input
-      self.write_content('callsets/search',
-                         body={'variantSetIds': [variant_set_id],
-                               'name': name},
-                         params='fields=callSets(id,name)')
+      call_sets = self.get_content('callsets/search',
+                                   body={'variantSetIds': [variant_set_id],
+                                         'name': name},
+                                   params='fields=callSets(id,name)')
 
     else:
       raise ApiException('Unsupported GA4GH version: %s' % ga4gh_api_version)
 
+    # Remember the variant set so variant searches don't have to look it up
+    for call_set in call_sets.get('callSets', []):
+      self.put_metadata('callSetVariantSet', call_set['id'], variant_set_id)
+
+    self.write_response(call_sets)
+
   def write_read_group_set(self, set_id):
-    rg_set = self.get_content('readgroupsets/%s' % set_id, method='GET')
+    rg_set = self.get_metadata('readGroupSet', set_id,
+                               lambda: self.load_read_group_set(set_id))
+    self.response.write(codec.dumps(rg_set))
+
+  def load_read_group_set(self, set_id):
+    def get_read_group_set():
+      return self.get_content('readgroupsets/%s' % set_id, method='GET')
+
+    def get_coverage_buckets():
+      return self.get_content('readgroupsets/%s/coveragebuckets' % set_id,
+                              method='GET')
+
+    # Where the backend has coverage buckets, they are fetched alongside the
+    # read group set rather than after it. They seed the coverage pyramids
+    # even when the references come from the reference set.
+    buckets = None
+    if self.supports_coverage_buckets():
+      rg_set, buckets = parallel.parallel_map(
+          lambda get: get(), [get_read_group_set, get_coverage_buckets], 2)
+      self.add_coverage_buckets(set_id, buckets)
+    else:
+      rg_set = get_read_group_set()
+
     # For read group sets, we also load up the reference set data
     reference_set_id = rg_set.get('referenceSetId') or \
                        rg_set['readGroups'][0].get('referenceSetId')
 
     if not reference_set_id:
-      buckets = self.get_content('readgroupsets/%s/coveragebuckets' % set_id,
-                                 method='GET')
+      if buckets is None:
+        buckets = get_coverage_buckets()
+        self.add_coverage_buckets(set_id, buckets)
       rg_set['references'] = [{'name': b['range']['referenceName'],
                                'length': b['range']['end']}
                               for b in buckets['coverageBuckets']]
     else:
-      references = self.get_content('references/search',
-                                    body={'referenceSetId': reference_set_id},
-                                    params='fields=references(name,length)')
-      rg_set['references'] = references['references']
-
-    self.response.write(json.dumps(rg_set))
+      rg_set['references'] = self.get_metadata(
+          'references', reference_set_id,
+          lambda: self.get_content(
+              'references/search',
+              body={'referenceSetId': reference_set_id},
+              params='fields=references(name,length)')['references'])
+
+    return rg_set
+
+  def add_coverage_buckets(self, set_id, buckets):
+    # These buckets give each reference's coarsest coverage level. Each
+    # reference's pyramid is stored (and saved) once, with all its buckets.
+    if 'bucketWidth' not in buckets:
+      return
+    by_reference = {}
+    for bucket in buckets.get('coverageBuckets', []):
+      by_reference.setdefault(bucket['range']['referenceName'], []).append(
+          bucket)
+    for reference_name, reference_buckets in by_reference.iteritems():
+      key = (self.get_backend(), set_id, reference_name)
+      set_pyramid = COVERAGE_PYRAMIDS.get(key) or pyramid.CoveragePyramid()
+      set_pyramid.add_buckets(int(buckets['bucketWidth']), reference_buckets)
+      COVERAGE_PYRAMIDS.put(key, set_pyramid)
 
   def write_call_set(self, set_id):
+    call_set = self.get_metadata('callSet', set_id,
+                                 lambda: self.load_call_set(set_id))
+    self.response.write(codec.dumps(call_set))
+
+  def load_call_set(self, set_id):
     call_set = self.get_content('callsets/%s' % set_id, method='GET')
 
     # For call sets, we also load up the variant set data to get
     # the available reference names and lengths
     variant_set_id = call_set['variantSetIds'][0]
-    variant_set = self.get_content('variantsets/%s' % variant_set_id,
-                                   method='GET')
+    self.put_metadata('callSetVariantSet', set_id, variant_set_id)
+    variant_set = self.get_metadata(
+        'variantSet', variant_set_id,
+        lambda: self.get_content('variantsets/%s' % variant_set_id,
+                                 method='GET'))
 
     # Google Genomics implements a custom extension (referenceBounds)
     # which provides the list of reference segments and the upper bounds
@@ -312,7 +885,7 @@ class SetSearchHandler(BaseRequestHandler):
           variant_set['referenceSetId'] == 'GRCh38'):
       call_set['references'] = GRCh38['common_segments']
 
-    self.response.write(json.dumps(call_set))
+    return call_set
 
   def get(self):
     set_type = self.request.get('setType')
@@ -336,6 +909,139 @@ class SetSearchHandler(BaseRequestHandler):
 
 class ReadSearchHandler(BaseRequestHandler):
 
+  def use_drain(self):
+    return self.request.get('drain').lower() in ('1', 'true')
+
+  def get_drain_budget(self, name, limit):
+    try:
+      return min(int(self.request.get(name) or limit), limit)
+    except ValueError:
+      raise ApiException('%s must be a number' % name)
+
+  def use_columnar(self):
+    # Clients opt in to the binary encoding through the Accept header
+    return readcodec.MEDIA_TYPE in self.request.headers.get('Accept', '')
+
+  def encode_page(self, content):
+    with self.trace.span('serialize'):
+      if self.use_columnar():
+        return readcodec.encode_page(content)
+      return codec.dumps(content) + '\n'
+
+  def encode_error(self, message):
+    if self.use_columnar():
+      return readcodec.encode_error(message)
+    return codec.dumps({'error': message}) + '\n'
+
+  def iter_drained_pages(self, content, get_page, max_reads, max_bytes):
+    # Follow the page tokens server-side, writing each page to the client as
+    # soon as it arrives (as a line of JSON, or a binary frame). Once the
+    # budget is used up the last page still carries its nextPageToken, so the
+    # client can continue with a new request. The first page is fetched up
+    # front so that errors there get a normal error response.
+    total_reads = total_bytes = 0
+
+    while True:
+      page = self.encode_page(content)
+      yield page
+
+      total_reads += len(content.get('alignments', []))
+      total_bytes += len(page)
+      page_token = content.get('nextPageToken')
+      if (not page_token or total_reads >= max_reads or
+          total_bytes >= max_bytes):
+        return
+
+      try:
+        content = get_page(page_token)
+      except ApiException, err:
+        yield self.encode_error(err.message)
+        return
+      except Exception:
+        logging.exception('Unexpected exception')
+        yield self.encode_error('Unexpected internal exception')
+        return
+
+  def use_fan_out(self):
+    fan_out = self.request.get('fanOut').lower()
+    if fan_out:
+      return fan_out in ('1', 'true')
+    return FANOUT_SEARCH
+
+  def use_merge(self, body):
+    # Fanning out only makes sense with more than one read group set
+    return self.use_fan_out() and len(body['readGroupSetIds']) > 1
+
+  def get_merged_content(self, body, params=''):
+    # Search each read group set concurrently, then k-way merge the pages
+    # by position. Reads are only returned up to the lowest last position of
+    # any set that still has more pages, so the combined stream stays sorted
+    # across pages. The page token records, per set, the upstream page token
+    # to fetch next and the position up to which that page was already
+    # returned (when only part of it was used).
+    if body.get('pageToken'):
+      try:
+        streams = codec.loads(base64.urlsafe_b64decode(
+            body['pageToken'].encode('ascii')))
+      except (TypeError, ValueError, UnicodeError):
+        raise ApiException('Invalid page token')
+    else:
+      streams = dict((set_id, [None, None])
+                     for set_id in body['readGroupSetIds'])
+
+    def read_position(read):
+      read_range = tiling.read_range(read)
+      return read_range[0] if read_range else 0
+
+    def search_set(set_id):
+      page_token, returned_through = streams[set_id]
+      set_body = dict(body, readGroupSetIds=[set_id])
+      set_body.pop('pageToken', None)
+      if page_token:
+        set_body['pageToken'] = page_token
+
+      content = self.get_content('reads/search', body=set_body, params=params)
+      reads = content.get('alignments', [])
+      last_position = read_position(reads[-1]) if reads \
+                      else (returned_through or -1)
+      if returned_through is not None:
+        reads = [read for read in reads
+                 if read_position(read) > returned_through]
+      return reads, last_position, content.get('nextPageToken')
+
+    set_ids = sorted(streams)
+    pages = parallel.parallel_map(search_set, set_ids, FANOUT_MAX_WORKERS)
+
+    # Sets with more pages limit how far we can safely merge
+    limits = [last_position for _, last_position, next_token in pages
+              if next_token]
+    merge_through = min(limits) if limits else None
+
+    with self.trace.span('filter', merge=len(set_ids)):
+      merged = heapq.merge(*[
+          [(read_position(read), index, order, read)
+           for order, read in enumerate(reads)]
+          for index, (reads, _, _) in enumerate(pages)])
+
+      alignments = []
+      for position, _, _, read in merged:
+        if merge_through is not None and position > merge_through:
+          break
+        alignments.append(read)
+
+    next_streams = {}
+    for set_id, (reads, last_position, next_token) in zip(set_ids, pages):
+      if merge_through is not None and last_position > merge_through:
+        next_streams[set_id] = [streams[set_id][0], merge_through]
+      elif next_token:
+        next_streams[set_id] = [next_token, None]
+
+    content = {'alignments': alignments}
+    if next_streams:
+      content['nextPageToken'] = base64.urlsafe_b64encode(
+          codec.dumps(next_streams))
+    return content
+
   def get(self):
     body = {
         'readGroupSetIds': self.request.get('setIds').split(','),
@@ -349,23 +1055,222 @@ class ReadSearchHandler(BaseRequestHandler):
       params = 'fields=nextPageToken,alignments(%s)' % read_fields
       body['pageSize'] = 1024
 
+    # Backends without partial responses need the fields filtered here
+    fields = None
+    if read_fields and not self.supports_partial_response():
+      fields = read_fields.split(',')
+
     page_token = self.request.get('pageToken')
-    if page_token:
-      body['pageToken'] = page_token
+    if not self.use_tiles() and not self.use_merge(body) and \
+       not self.use_drain() and not self.use_columnar():
+      # A single upstream page; hand it on as is, or project the requested
+      # fields while streaming it out.
+      if page_token:
+        body['pageToken'] = page_token
+      if fields:
+        content = self.get_raw_content('reads/search', body=body,
+                                       params=params)
+        self.write_stream(
+            jsonstream.iter_projected(content, 'alignments', fields),
+            content_type='application/json')
+      else:
+        self.write_content('reads/search', body=body, params=params)
+      return
 
-    content = self.get_content('reads/search', body=body, params=params)
+    if self.use_drain():
+      # Parsed before anything is streamed, so bad values get a 400
+      max_reads = self.get_drain_budget('maxReads', DRAIN_MAX_READS)
+      max_bytes = self.get_drain_budget('maxBytes', DRAIN_MAX_BYTES)
+
+    content = self.get_reads_page(body, params, fields, page_token)
+
+    if self.use_drain():
+      self.write_stream(
+          self.iter_drained_pages(
+              content, lambda page_token: self.get_reads_page(
+                  body, params, fields, page_token),
+              max_reads, max_bytes),
+          content_type=readcodec.MEDIA_TYPE if self.use_columnar()
+                       else 'application/x-ndjson')
+    elif self.use_columnar():
+      self.response.headers['Content-Type'] = readcodec.MEDIA_TYPE
+      self.response.write(self.encode_page(content))
+    else:
+      self.write_response(content)
+
+  def get_reads_page(self, body, params, fields=None, page_token=None):
+    def search(page_body):
+      if self.use_merge(page_body):
+        return self.get_merged_content(page_body, params)
+      if fields and not self.use_tiles():
+        # Emulate partial responses, projecting each read while parsing
+        content = self.get_raw_content('reads/search', body=page_body,
+                                       params=params)
+        with self.trace.span('parse', path='reads/search', projected=True):
+          return jsonstream.load_projected(content, 'alignments', fields)
+      return self.get_content('reads/search', body=page_body, params=params)
+
+    if self.use_tiles():
+      content = self.get_tiled_content(search, 'alignments', tiling.read_range,
+                                       body, page_token)
+    else:
+      page_body = dict(body)
+      if page_token:
+        page_body['pageToken'] = page_token
+      content = search(page_body)
+
+    # Tiled and merged pages are projected only once they've been trimmed
+    # and merged, since that needs the alignment positions.
+    if fields and (self.use_tiles() or self.use_merge(body)):
+      with self.trace.span('filter', project=len(fields)):
+        content['alignments'] = [jsonstream.project(read, fields)
+                                 for read in content['alignments']]
 
-    # Emulate support for partial responses by supplying only the
-    # requested fields to the client.
-    if read_fields and not self.supports_partial_response():
-      fields = read_fields.split(',')
-      def filterKeys(dictionary, keys):
-        return {key: dictionary[key] for key in keys}
+    return content
+
+
+class CoverageHandler(BaseRequestHandler):
+
+  def get_buckets(self, set_id, reference_name, bucket_width):
+    buckets = []
+    page_token = None
+    while True:
+      query = {'referenceName': reference_name,
+               'targetBucketWidth': bucket_width}
+      if page_token:
+        query['pageToken'] = page_token
+
+      content = self.get_content(
+          'readgroupsets/%s/coveragebuckets' % set_id, method='GET',
+          params=urllib.urlencode(query))
+      buckets.extend(content.get('coverageBuckets', []))
+
+      page_token = content.get('nextPageToken')
+      if not page_token:
+        return int(content.get('bucketWidth', bucket_width)), buckets
+
+  def get_pyramid(self, set_id, reference_name):
+    key = (self.get_backend(), set_id, reference_name)
+    set_pyramid = COVERAGE_PYRAMIDS.get(key)
+    if set_pyramid is None:
+      set_pyramid = pyramid.CoveragePyramid()
+
+    if self.supports_coverage_buckets() and \
+       PYRAMID_BUCKET_WIDTH not in set_pyramid.bucket_widths:
+      bucket_width, buckets = self.get_buckets(set_id, reference_name,
+                                               PYRAMID_BUCKET_WIDTH)
+      set_pyramid.add_buckets(bucket_width, buckets, PYRAMID_BUCKET_WIDTH)
+      COVERAGE_PYRAMIDS.put(key, set_pyramid)
+
+    return set_pyramid
+
+  def refine_pyramid(self, set_pyramid, key, reads, start, end):
+    # Add depth from a complete set of reads for a window aligned to the
+    # refined bin size.
+    bin_size = PYRAMID_REFINED_BIN_SIZE
+    depth, _ = coverage.from_reads(reads, start, end, bin_size)
+    set_pyramid.add(bin_size, start // bin_size, depth)
+    COVERAGE_PYRAMIDS.put(key, set_pyramid)
+
+  def get_reads(self, body, count_bases):
+    # Only the alignments (and bases if needed) are used
+    params = ''
+    if self.supports_partial_response():
+      params = 'fields=nextPageToken,alignments(alignment(position,cigar)%s)' \
+               % (',alignedSequence' if count_bases else '')
+      body['pageSize'] = 1024
 
-      new_reads = [filterKeys(read, fields) for read in content['alignments']]
-      content['alignments'] = new_reads
+    reads = []
+    for _ in range(COVERAGE_MAX_READ_PAGES):
+      content = self.get_content('reads/search', body=body, params=params)
+      reads.extend(content.get('alignments', []))
 
-    self.write_response(content)
+      body['pageToken'] = content.get('nextPageToken')
+      if not body['pageToken']:
+        return reads, False
+    return reads, True
+
+  def get(self):
+    set_ids = self.request.get('setIds').split(',')
+    reference_name = self.request.get('sequenceName')
+    start = max(0, int(self.request.get('sequenceStart')))
+    end = int(self.request.get('sequenceEnd'))
+    if end <= start:
+      raise ApiException('sequenceEnd must be after sequenceStart')
+
+    bin_size = int(self.request.get('binSize') or
+                   max(1, (end - start) // COVERAGE_DEFAULT_BINS))
+    if bin_size < 1 or \
+       coverage.get_bin_count(start, end, bin_size) > COVERAGE_MAX_BINS:
+      raise ApiException('binSize is too small for this window')
+
+    count_bases = self.request.get('bases').lower() in ('1', 'true')
+    if count_bases and bin_size > COVERAGE_BASE_COUNTS_MAX_BIN_SIZE:
+      raise ApiException('Base counts need a binSize of at most %d'
+                         % COVERAGE_BASE_COUNTS_MAX_BIN_SIZE)
+
+    result = {
+        'referenceName': reference_name,
+        'start': start,
+        'end': end,
+        'binSize': bin_size,
+    }
+
+    # Try to answer from the pyramids first, which needs no upstream calls
+    # once they are built. Depth is summed over the sets.
+    pyramids = parallel.parallel_map(
+        lambda set_id: self.get_pyramid(set_id, reference_name),
+        set_ids, FANOUT_MAX_WORKERS)
+    answers = [set_pyramid.query(start, end, bin_size)
+               for set_pyramid in pyramids]
+    pyramid_depth = None
+    if all(answers):
+      pyramid_depth = [sum(depths) for depths in
+                       zip(*[depth for depth, _ in answers])]
+      level_size = max(size for _, size in answers)
+      if not count_bases and (
+          level_size <= bin_size * PYRAMID_MAX_COARSENING or
+          end - start > COVERAGE_MAX_READ_WINDOW):
+        result['depth'] = pyramid_depth
+        result['source'] = 'pyramid'
+        self.write_response(result)
+        return
+
+    # Search a slightly bigger window, aligned to the pyramid's refined bins,
+    # so that the reads can be used to refine it too.
+    read_start = start - start % PYRAMID_REFINED_BIN_SIZE
+    read_end = end + -end % PYRAMID_REFINED_BIN_SIZE
+    reads, truncated = self.get_reads({
+        'readGroupSetIds': set_ids,
+        'referenceName': reference_name,
+        'start': read_start,
+        'end': read_end,
+    }, count_bases)
+
+    if truncated and pyramid_depth is not None and not count_bases:
+      # A coarse but complete answer beats a truncated one
+      result['depth'] = pyramid_depth
+      result['source'] = 'pyramid'
+      self.write_response(result)
+      return
+
+    result['depth'], counts = coverage.from_reads(reads, start, end,
+                                                  bin_size, count_bases)
+    if counts:
+      result['counts'] = counts
+    result['source'] = 'reads'
+    # Depth from a truncated read search is a lower bound
+    result['truncated'] = truncated
+
+    # Reads can only be attributed to a set when there is just the one, and
+    # only windows small enough to compute from reads are worth keeping
+    if not truncated and len(set_ids) == 1 and \
+       end - start <= COVERAGE_MAX_READ_WINDOW:
+      self.refine_pyramid(pyramids[0],
+                          (self.get_backend(), set_ids[0], reference_name),
+                          reads, read_start, read_end)
+
+    self.write_response(result)
 
 
 class VariantSearchHandler(BaseRequestHandler):
@@ -389,11 +1294,18 @@ class VariantSearchHandler(BaseRequestHandler):
       # and hence it is not passed in here.
       
       # For now, just look up the variantSetId for each callset
-      # (and make sure they all belong to the same one)
-      variant_set_ids = set()
-      for set_id in self.request.get('setIds').split(','):
-        call_set = self.get_content('callsets/%s' % set_id, method='GET')
-        variant_set_ids.add(call_set['variantSetIds'][0])
+      # (and make sure they all belong to the same one). These are usually
+      # cached from when the call sets were loaded; any that aren't are
+      # looked up concurrently.
+      def get_variant_set_id(set_id):
+        return self.get_metadata(
+            'callSetVariantSet', set_id,
+            lambda: self.get_content('callsets/%s' % set_id,
+                                     method='GET')['variantSetIds'][0])
+
+      variant_set_ids = set(parallel.parallel_map(
+          get_variant_set_id, self.request.get('setIds').split(','),
+          FANOUT_MAX_WORKERS))
 
       if len(variant_set_ids) != 1:
         raise ApiException('callsets must all come from the same variantset')
@@ -401,21 +1313,104 @@ class VariantSearchHandler(BaseRequestHandler):
       body['variantSetId'] = variant_set_ids.pop()
 
     page_token = self.request.get('pageToken')
+    if self.use_tiles():
+      search = lambda page_body: self.get_content('variants/search',
+                                                  body=page_body)
+      self.write_response(self.get_tiled_content(
+          search, 'variants', tiling.variant_range, body, page_token))
+      return
+
     if page_token:
       body['pageToken'] = page_token
     self.write_content('variants/search', body=body)
 
 
-class BaseSnpediaHandler(webapp2.RequestHandler):
-  http = httplib2.Http(timeout=60)
+class BaseSnpediaHandler(InstrumentedRequestHandler):
+  http = make_transport()
+
+  def get_metrics_backend(self):
+    return 'SNPedia'
 
   def getSnppediaPageContent(self, snp):
+    content = SNPEDIA_CACHE.get(snp) if SNPEDIA_CACHE else None
+    if content is None:
+      content = self.fetchSnppediaPages([snp])[snp]
+      if SNPEDIA_CACHE:
+        SNPEDIA_CACHE.put(snp, content)
+
+    if content is snpcache.MISSING:
+      raise KeyError(snp)
+    return content
+
+  def getSnppediaPageContents(self, titles, timeout=None):
+    """Look up many pages, returning a dict of those found by title.
+
+    Uncached pages are fetched in concurrent batches. Batches which fail, or
+    haven't finished within the timeout, are left out.
+    """
+    contents = {}
+    uncached = []
+    for title in set(titles):
+      content = SNPEDIA_CACHE.get(title) if SNPEDIA_CACHE else None
+      if content is None:
+        uncached.append(title)
+      else:
+        contents[title] = content
+
+    def fetch(batch):
+      try:
+        return self.fetchSnppediaPages(batch)
+      except (ValueError, KeyError, socket.error,
+              httplib2.HttpLib2Error, transport.PoolTimeout), err:
+        logging.warning('SNPedia lookup of %d pages failed: %s',
+                        len(batch), err)
+        return None
+
+    batches = [uncached[i:i + SNPEDIA_MAX_TITLES]
+               for i in range(0, len(uncached), SNPEDIA_MAX_TITLES)]
+    for pages in parallel.parallel_map(fetch, batches, SNPEDIA_MAX_WORKERS,
+                                       timeout=timeout):
+      for title, content in (pages or {}).iteritems():
+        if SNPEDIA_CACHE:
+          SNPEDIA_CACHE.put(title, content)
+        contents[title] = content
+
+    return dict((title, content) for title, content in contents.iteritems()
+                if content is not snpcache.MISSING)
+
+  def fetchSnppediaPages(self, titles):
+    """Fetch pages by title, returning their content (or MISSING) by title"""
     uri = ('http://bots.snpedia.com/api.php?action=query&prop=revisions&'
-           'format=json&rvprop=content&titles=%s' % snp)
-    response, content = self.http.request(uri=uri)
+           'format=json&rvprop=content&titles=%s' %
+           urllib.quote('|'.join(titles).encode('utf-8'), safe='|();'))
+    start_time = time.time()
+    self.upstream_pages.append('api.php')
+    with self.trace.span('upstream', path='api.php',
+                         titles=len(titles)) as span:
+      try:
+        response, content = self.http.request(uri=uri)
+      except Exception:
+        record_upstream_request('SNPedia', 'api.php', start_time, 'error')
+        raise
+      span['status'] = response.status
+      span['bytes'] = len(content)
+    record_upstream_request('SNPedia', 'api.php', start_time,
+                            response.status, len(content))
+
+    with self.trace.span('parse', path='api.php'):
+      query = codec.loads(content)['query']
+    # MediaWiki answers for titles as it normalized them (e.g. rs1 -> Rs1)
+    normalized = dict((n['from'], n['to'])
+                      for n in query.get('normalized', []))
+    pages = {}
+    for page in query['pages'].itervalues():
+      if 'missing' in page or 'invalid' in page:
+        pages[page['title']] = snpcache.MISSING
+      else:
+        pages[page['title']] = page['revisions'][0]['*']
 
-    page_id, page = json.loads(content)['query']['pages'].popitem()
-    return page['revisions'][0]['*']
+    return dict((title, pages[normalized.get(title, title)])
+                for title in titles if normalized.get(title, title) in pages)
 
   def getContentValue(self, content, key):
     try:
@@ -438,22 +1433,43 @@ class SnpSearchHandler(BaseSnpediaHandler):
         'chr': self.getContentValue(content, 'chromosome')
     }
 
+  def getIndexedSnps(self, snp):
+    if not SNP_INDEX:
+      return []
+    if snp[:2].lower() == 'rs':
+      snps = [SNP_INDEX.find_snp(snp)]
+    else:
+      snps = SNP_INDEX.find_gene(snp)
+    return [{
+        'name': s['name'],
+        'link': 'http://www.snpedia.com/index.php/%s' % s['name'],
+        'position': s['position'],
+        'chr': s['chr'],
+    } for s in snps if s]
+
   def get(self):
     snp = self.request.get('snp')
 
+    snps = self.getIndexedSnps(snp)
+    if snps:
+      self.response.write(codec.dumps({'snps': snps}))
+      return
+
     try:
       content = self.getSnppediaPageContent(snp)
       if snp[:2].lower() == 'rs':
         snps = [self.getSnpResponse(snp, content)]
       else:
         # Try a gene format
-        snps = re.findall('\[\[(rs\d+?)\]\]', content, re.I)
-        snps = [self.getSnpResponse(s, self.getSnppediaPageContent(s))
-                for s in set(snps)]
+        names = set(re.findall('\[\[(rs\d+?)\]\]', content, re.I))
+        contents = self.getSnppediaPageContents(
+            names, timeout=SNPEDIA_TIME_BUDGET)
+        snps = [self.getSnpResponse(name, contents[name])
+                for name in names if name in contents]
 
     except (ValueError, KeyError, AttributeError):
       snps = []
-    self.response.write(json.dumps({'snps': snps}))
+    self.response.write(codec.dumps({'snps': snps}))
 
 
 class AlleleSearchHandler(BaseSnpediaHandler):
@@ -467,42 +1483,142 @@ class AlleleSearchHandler(BaseSnpediaHandler):
         'magnitude': self.getContentValue(content, 'magnitude')
     }
 
-  def get(self):
-    snp = self.request.get('snp')
-    a1 = self.request.get('a1')
-    a2 = self.request.get('a2')
-
+  def getGenotypePages(self, snp, a1, a2):
+    """Return the possible page names for a genotype, most preferred first"""
     a1c = self.complement(a1)
     a2c = self.complement(a2)
     possible_names = [(snp, a1, a2), (snp, a2, a1),
                       (snp, a1c, a2c), (snp, a2c, a1c)]
-    for name in possible_names:
+    return ['%s(%s;%s)' % name for name in possible_names]
+
+  def getAlleleResponses(self, genotypes):
+    # Every possible page of every genotype is looked up together, and each
+    # genotype gets its first page that exists.
+    pages = []
+    for snp, a1, a2 in genotypes:
+      try:
+        pages.append(self.getGenotypePages(snp, a1, a2))
+      except KeyError:
+        pages.append([])  # Not a pair of bases
+
+    contents = self.getSnppediaPageContents(
+        [page for names in pages for page in names],
+        timeout=SNPEDIA_TIME_BUDGET)
+
+    responses = []
+    for names in pages:
+      found = [page for page in names if page in contents]
+      responses.append(
+          self.getAlleleResponse(found[0], contents[found[0]]) if found
+          else {})
+    return responses
+
+  def get(self):
+    alleles = self.request.get('alleles')
+    if alleles:
+      # Bulk mode: a comma separated list of snp:a1:a2 genotypes, answered
+      # with a list of responses in the same order
+      genotypes = [genotype.split(':') for genotype in alleles.split(',')]
+      if (len(genotypes) > SNPEDIA_MAX_GENOTYPES or
+          any(len(genotype) != 3 for genotype in genotypes)):
+        self.response.write('Invalid alleles parameter')
+        self.response.set_status(400)
+        return
+      self.response.write(codec.dumps(
+          {'alleles': self.getAlleleResponses(genotypes)}))
+      return
+
+    genotype = (self.request.get('snp'), self.request.get('a1'),
+                self.request.get('a2'))
+    self.response.write(codec.dumps(self.getAlleleResponses([genotype])[0]))
+
+
+class MetricsHandler(webapp2.RequestHandler):
+
+  def get(self):
+    self.response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    self.response.write(METRICS.render())
+
+
+class ProfileHandler(webapp2.RequestHandler):
+  """Serves the profiles of each route (see PROFILE_SAMPLE_RATE)"""
+
+  def dispatch(self):
+    # On App Engine only administrators get this far
+    if not IS_APP_ENGINE and not is_local_request(self.request):
+      self.abort(403)
+    webapp2.RequestHandler.dispatch(self)
+
+  def get(self):
+    route = self.request.get('route')
+    if not route:
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.write(codec.dumps(PROFILER.get_routes()))
+      return
+
+    output_format = self.request.get(
+        'format', 'collapsed' if PROFILE_MODE == 'sample' else 'text')
+    if output_format == 'pstats':
+      content_type = 'application/octet-stream'
+      content = PROFILER.get_pstats(route)
+      self.response.headers['Content-Disposition'] = \
+          'attachment; filename="%s.pstats"' % route.strip('/').replace(
+              '/', '-')
+    elif output_format == 'collapsed':
+      content_type = 'text/plain'
+      content = PROFILER.get_collapsed(route)
+    elif output_format == 'text':
+      content_type = 'text/plain'
       try:
-        page = '%s(%s;%s)' % name
-        content = self.getSnppediaPageContent(page)
-        self.response.write(json.dumps(self.getAlleleResponse(page, content)))
+        content = PROFILER.get_text(route,
+                                    self.request.get('sort', 'cumulative'))
+      except KeyError:
+        self.response.set_status(400)
+        self.response.write('Unknown sort key')
         return
-      except (ValueError, KeyError, AttributeError):
-        pass  # Continue trying the next allele name
+    else:
+      self.response.set_status(400)
+      self.response.write('format must be pstats, collapsed or text')
+      return
+
+    if content is None:
+      self.response.set_status(404)
+      self.response.write('No %s profile for %s' % (output_format, route))
+      return
+    self.response.headers['Content-Type'] = content_type
+    self.response.write(content)
 
-    self.response.write(json.dumps({}))
+  def delete(self):
+    PROFILER.reset(self.request.get('route') or None)
 
 
 class MainHandler(webapp2.RequestHandler):
 
   def get(self):
     template = JINJA_ENVIRONMENT.get_template('main.html')
+    static_url = JINJA_ENVIRONMENT.globals['static_url']
     self.response.write(template.render({
         'backends': SUPPORTED_BACKENDS,
+        # The images that scripts load themselves
+        'image_urls': codec.dumps(dict(
+            (path, static_url(path)) for path in STATIC_MANIFEST
+            if path.startswith('img/'))),
     }))
 
 web_app = webapp2.WSGIApplication(
     [
         ('/', MainHandler),
         ('/api/reads', ReadSearchHandler),
+        ('/api/coverage', CoverageHandler),
         ('/api/variants', VariantSearchHandler),
         ('/api/sets', SetSearchHandler),
         ('/api/snps', SnpSearchHandler),
         ('/api/alleles', AlleleSearchHandler),
+        ('/api/metrics', MetricsHandler),
+        ('/admin/profile', ProfileHandler),
     ],
     debug=True)
+
+if COMPRESS_RESPONSES:
+  web_app = compression.CompressionMiddleware(
+      web_app, path_prefix='/api/', min_size=COMPRESSION_MIN_SIZE)
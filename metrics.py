@@ -0,0 +1,201 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+In-process metrics, exposed in the Prometheus text format.
+
+A Registry holds counters and histograms, which are updated as requests
+are handled, and collectors: functions called when the metrics are
+rendered, which report numbers other objects already keep (like cache
+hits). Metrics are kept per process, so with several worker processes
+(localserver.py --workers) or App Engine instances each one reports its
+own, and Prometheus adds them up.
+"""
+
+import threading
+
+# Histogram buckets for latencies, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+# Histogram buckets for sizes, in bytes
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+
+# Histogram buckets for counts of things, like pages
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+  return (unicode(value).replace('\\', r'\\').replace('"', r'\"')
+          .replace('\n', r'\n'))
+
+
+def _format_labels(names, values, extra=()):
+  pairs = zip(names, values) + list(extra)
+  if not pairs:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                           for name, value in pairs)
+
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  if isinstance(value, (int, long)):
+    return str(value)
+  if isinstance(value, float) and value.is_integer():
+    return str(int(value))
+  return repr(value)
+
+
+class _Metric(object):
+
+  type = None
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self._lock = threading.Lock()
+    self._values = {}
+
+  def _check(self, labels):
+    labels = tuple(labels)
+    if len(labels) != len(self.labels):
+      raise ValueError('%s needs labels %s' % (self.name, self.labels))
+    return labels
+
+  def _header(self):
+    return ['# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type)]
+
+
+class Counter(_Metric):
+  """A count which only goes up, per combination of label values"""
+
+  type = 'counter'
+
+  def inc(self, labels=(), amount=1):
+    labels = self._check(labels)
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def get(self, labels=()):
+    with self._lock:
+      return self._values.get(tuple(labels), 0)
+
+  def render(self):
+    with self._lock:
+      values = sorted(self._values.items())
+    lines = self._header()
+    for labels, value in values:
+      lines.append('%s%s %s' % (self.name,
+                                _format_labels(self.labels, labels),
+                                _format_value(value)))
+    return lines
+
+
+class Histogram(_Metric):
+  """Observations counted into buckets, per combination of label values"""
+
+  type = 'histogram'
+
+  def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+    _Metric.__init__(self, name, help, labels)
+    self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+  def observe(self, value, labels=()):
+    labels = self._check(labels)
+    with self._lock:
+      counts = self._values.get(labels)
+      if counts is None:
+        # Per-bucket counts, then the sum of all observations
+        counts = self._values[labels] = [0] * len(self.buckets) + [0]
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+          break
+      counts[-1] += value
+
+  def render(self):
+    with self._lock:
+      values = sorted((labels, list(counts))
+                      for labels, counts in self._values.iteritems())
+    lines = self._header()
+    for labels, counts in values:
+      total = 0
+      for bound, count in zip(self.buckets, counts):
+        total += count
+        lines.append('%s_bucket%s %d' % (
+            self.name,
+            _format_labels(self.labels, labels,
+                           [('le', _format_value(bound))]),
+            total))
+      lines.append('%s_sum%s %s' % (self.name,
+                                    _format_labels(self.labels, labels),
+                                    _format_value(counts[-1])))
+      lines.append('%s_count%s %d' % (self.name,
+                                      _format_labels(self.labels, labels),
+                                      total))
+    return lines
+
+
+class Registry(object):
+  """A set of metrics and collectors, rendered together"""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._metrics = []
+    self._collectors = []
+
+  def _add(self, metric):
+    with self._lock:
+      self._metrics.append(metric)
+    return metric
+
+  def counter(self, name, help, labels=()):
+    return self._add(Counter(name, help, labels))
+
+  def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+    return self._add(Histogram(name, help, labels, buckets))
+
+  def add_collector(self, collect):
+    """Add a function to call when rendering.
+
+    It should return a list of (name, type, help, label names, samples),
+    where samples is a list of (label values, value) and type is 'counter'
+    or 'gauge'.
+    """
+    with self._lock:
+      self._collectors.append(collect)
+
+  def render(self):
+    with self._lock:
+      metrics = list(self._metrics)
+      collectors = list(self._collectors)
+
+    lines = []
+    for metric in metrics:
+      lines.extend(metric.render())
+    for collect in collectors:
+      for name, type, help, labels, samples in collect():
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, type))
+        for label_values, value in samples:
+          lines.append('%s%s %s' % (name,
+                                    _format_labels(labels, label_values),
+                                    _format_value(value)))
+    return '\n'.join(lines) + '\n'
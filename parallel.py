@@ -0,0 +1,79 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A minimal bounded thread pool for issuing upstream calls concurrently.
+
+Threads are started per call and joined before returning (unless a timeout
+runs out first), which keeps this usable inside App Engine request handlers.
+"""
+
+import Queue
+import sys
+import threading
+import time
+
+# Default upper bound on the number of concurrent calls
+DEFAULT_MAX_WORKERS = 8
+
+
+def parallel_map(func, items, max_workers=DEFAULT_MAX_WORKERS, timeout=None):
+  """Call func on each item concurrently, returning results in order.
+
+  If any call raises, the first exception (in item order) is re-raised
+  once all calls have finished. With a timeout (in seconds), stops waiting
+  once it has passed: no more calls are started, and the items that haven't
+  finished get a result of None.
+  """
+  items = list(items)
+  deadline = time.time() + timeout if timeout is not None else None
+  if deadline is None and (len(items) <= 1 or max_workers <= 1):
+    # Without a timeout there's no need for a thread to wait on
+    return [func(item) for item in items]
+
+  results = [None] * len(items)
+  errors = [None] * len(items)
+  pending = Queue.Queue()
+  for index, item in enumerate(items):
+    pending.put((index, item))
+
+  def worker():
+    while deadline is None or time.time() < deadline:
+      try:
+        index, item = pending.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        result = func(item)
+      except Exception:
+        errors[index] = sys.exc_info()
+      else:
+        results[index] = result
+
+  threads = [threading.Thread(target=worker)
+             for _ in range(min(max_workers, len(items)))]
+  for thread in threads:
+    # Calls still running after the timeout are left to finish on their own
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join(None if deadline is None else
+                max(0, deadline - time.time()))
+
+  # Take a copy so that late calls can't change what the caller sees
+  results = list(results)
+  for error in list(errors):
+    if error:
+      raise error[0], error[1], error[2]
+  return results
@@ -0,0 +1,239 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Profiling of sampled requests, aggregated per route.
+
+A Profiler profiles a request in one of two modes:
+
+  cprofile  cProfile, which times every function call. Its results are
+            kept per route as pstats.Stats, and can be dumped in the pstats
+            format (for pstats, snakeviz, gprof2dot, ...) or as text.
+  sample    a stack sampler, which looks at what the request's thread is
+            doing every SAMPLE_INTERVAL seconds. It costs far less per call,
+            and its results are kept per route as collapsed stacks, the
+            input format of flamegraph.pl and speedscope.
+
+The sampler runs in a thread of its own, started when a sampled request
+begins and stopping once no request is being sampled, so it never
+outlives the requests it samples (App Engine waits for a request's
+threads to end).
+
+Both only see the thread handling the request: time spent in worker
+threads (see parallel.py) shows up as the handling thread waiting for
+them. Under gevent, cProfile also sees the other greenlets running in the
+same thread, and the sampler only gets to run when greenlets yield, so
+its samples are biased towards waiting on I/O.
+
+A request is profiled within a session, which can be entered and left
+several times (as a streamed response is written out chunk by chunk):
+
+  session = profiler.start('/api/reads', 'sample')
+  with session:
+    ...
+  session.finish()
+
+Requests which aren't profiled get DISABLED, whose methods do nothing.
+"""
+
+import collections
+import cProfile
+import cStringIO
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+MODES = ('cprofile', 'sample')
+
+# Seconds between stack samples
+SAMPLE_INTERVAL = 0.005
+
+
+class _DisabledSession(object):
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc_info):
+    pass
+
+  def finish(self):
+    pass
+
+DISABLED = _DisabledSession()
+
+
+class _CProfileSession(object):
+
+  def __init__(self, profiler, route):
+    self._profiler = profiler
+    self._route = route
+    self._profile = cProfile.Profile()
+
+  def __enter__(self):
+    self._profile.enable()
+
+  def __exit__(self, *exc_info):
+    self._profile.disable()
+
+  def finish(self):
+    self._profiler._add_profile(self._route, self._profile)
+
+
+class _SampleSession(object):
+
+  def __init__(self, profiler, route):
+    self._profiler = profiler
+    self._route = route
+
+  def __enter__(self):
+    self._profiler._watch(threading.current_thread().ident, self._route)
+
+  def __exit__(self, *exc_info):
+    self._profiler._unwatch(threading.current_thread().ident)
+
+  def finish(self):
+    self._profiler._count_request(self._route)
+
+
+def _frame_name(frame):
+  code = frame.f_code
+  module = os.path.splitext(os.path.basename(code.co_filename))[0]
+  return '%s:%s' % (module, code.co_name)
+
+
+class Profiler(object):
+  """Profiles requests and keeps their results per route"""
+
+  def __init__(self, interval=SAMPLE_INTERVAL):
+    self.interval = interval
+    self._lock = threading.Lock()
+    self._requests = collections.defaultdict(int)
+    self._stats = {}
+    self._stacks = collections.defaultdict(collections.Counter)
+
+    # Threads to sample (ident -> route), and the thread sampling them
+    self._watched = {}
+    self._sampler = None
+
+  def start(self, route, mode):
+    """Return a session profiling a request to route, or DISABLED"""
+    if mode == 'cprofile':
+      return _CProfileSession(self, route)
+    if mode == 'sample':
+      return _SampleSession(self, route)
+    return DISABLED
+
+  def _add_profile(self, route, profile):
+    with self._lock:
+      self._requests[route] += 1
+      if route in self._stats:
+        self._stats[route].add(profile)
+      else:
+        self._stats[route] = pstats.Stats(profile)
+
+  def _count_request(self, route):
+    with self._lock:
+      self._requests[route] += 1
+
+  def _watch(self, ident, route):
+    with self._lock:
+      self._watched[ident] = route
+      if self._sampler is None:
+        self._sampler = threading.Thread(target=self._sample,
+                                         name='profiler sampler')
+        self._sampler.daemon = True
+        self._sampler.start()
+
+  def _unwatch(self, ident):
+    with self._lock:
+      self._watched.pop(ident, None)
+
+  def _sample(self):
+    # Stops as soon as there are no threads to sample; _watch starts a new
+    # sampler for the next one
+    own_ident = threading.current_thread().ident
+    while True:
+      time.sleep(self.interval)
+      with self._lock:
+        if not self._watched:
+          self._sampler = None
+          return
+        watched = dict(self._watched)
+      frames = sys._current_frames()
+
+      stacks = []
+      for ident, route in watched.iteritems():
+        frame = frames.get(ident)
+        if frame is None or ident == own_ident:
+          continue
+        names = []
+        while frame is not None:
+          names.append(_frame_name(frame))
+          frame = frame.f_back
+        stacks.append((route, ';'.join(reversed(names))))
+      del frames
+
+      with self._lock:
+        for route, stack in stacks:
+          self._stacks[route][stack] += 1
+
+  def get_routes(self):
+    """Return the number of requests and stack samples for each route"""
+    with self._lock:
+      return dict((route, {
+          'requests': self._requests[route],
+          'samples': sum(self._stacks[route].itervalues())
+                     if route in self._stacks else 0,
+          'cprofile': route in self._stats,
+      }) for route in self._requests)
+
+  def get_pstats(self, route):
+    """Return a route's cProfile results in the pstats file format"""
+    with self._lock:
+      stats = self._stats.get(route)
+      return marshal.dumps(stats.stats) if stats else None
+
+  def get_text(self, route, sort='cumulative', limit=50):
+    """Return a route's cProfile results as a text report"""
+    with self._lock:
+      stats = self._stats.get(route)
+      if not stats:
+        return None
+      out = cStringIO.StringIO()
+      stats.stream = out
+      stats.sort_stats(sort).print_stats(limit)
+      stats.stream = sys.stdout
+      return out.getvalue()
+
+  def get_collapsed(self, route):
+    """Return a route's stack samples as collapsed stacks"""
+    with self._lock:
+      stacks = self._stacks.get(route)
+      if not stacks:
+        return None
+      return ''.join('%s %d\n' % (stack, count)
+                     for stack, count in sorted(stacks.iteritems()))
+
+  def reset(self, route=None):
+    """Drop the results for a route, or all of them"""
+    with self._lock:
+      for results in (self._requests, self._stats, self._stacks):
+        if route is None:
+          results.clear()
+        else:
+          results.pop(route, None)
@@ -0,0 +1,240 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Multi-resolution coverage pyramids.
+
+A pyramid holds the binned depth of one read group set on one reference at
+several bin sizes. Each level is a set of runs of consecutive bins, so it
+can be filled in piecemeal: whole references from coverage buckets, and
+small windows at finer resolution as depth gets computed from reads.
+Every run is also averaged up into the coarser levels above it.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+import coverage
+
+# Each level's bins are this many times wider than the level below
+LEVEL_FACTOR = 4
+
+# Runs are not averaged up into levels coarser than this
+MAX_BIN_SIZE = 4 ** 12
+
+# Pyramids kept in memory by default; the least recently used are dropped
+# (those saved to disk are loaded again when next needed)
+MAX_ENTRIES = 1000
+
+
+class CoveragePyramid(object):
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # bin size -> sorted list of [first bin index, [depth, ...]]
+    self.levels = {}
+    # The targetBucketWidths that have already been loaded
+    self.bucket_widths = set()
+
+  def _add_run(self, bin_size, first, depths):
+    # Merge the run with any runs it overlaps or touches; the new depths
+    # take precedence.
+    last = first + len(depths)
+    runs = self.levels.setdefault(bin_size, [])
+    kept = []
+    merged_first, merged_last = first, last
+    touching = []
+    for run in runs:
+      run_first, run_last = run[0], run[0] + len(run[1])
+      if run_last < first or run_first > last:
+        kept.append(run)
+      else:
+        touching.append(run)
+        merged_first = min(merged_first, run_first)
+        merged_last = max(merged_last, run_last)
+
+    merged = [0.0] * (merged_last - merged_first)
+    for run_first, run_depths in touching:
+      merged[run_first - merged_first:
+             run_first - merged_first + len(run_depths)] = run_depths
+    merged[first - merged_first:last - merged_first] = depths
+
+    kept.append([merged_first, merged])
+    kept.sort()
+    self.levels[bin_size] = kept
+
+  def add(self, bin_size, first, depths):
+    """Add depths for consecutive bins, and average them up the levels"""
+    with self._lock:
+      while depths and bin_size <= MAX_BIN_SIZE:
+        self._add_run(bin_size, first, depths)
+
+        # Only whole groups of bins can be averaged into the next level
+        skip = -first % LEVEL_FACTOR
+        first = (first + skip) // LEVEL_FACTOR
+        depths = [sum(depths[i:i + LEVEL_FACTOR]) / LEVEL_FACTOR
+                  for i in range(skip, len(depths) - LEVEL_FACTOR + 1,
+                                 LEVEL_FACTOR)]
+        bin_size *= LEVEL_FACTOR
+
+  def add_buckets(self, bucket_width, buckets, target_bucket_width=None):
+    """Add coverage buckets from one reference"""
+    runs = []
+    for bucket in buckets:
+      index = int(bucket['range'].get('start', 0)) // bucket_width
+      depth = float(bucket.get('meanCoverage', 0))
+      if runs and runs[-1][0] + len(runs[-1][1]) == index:
+        runs[-1][1].append(depth)
+      else:
+        runs.append((index, [depth]))
+
+    for first, depths in runs:
+      self.add(bucket_width, first, depths)
+    with self._lock:
+      self.bucket_widths.add(target_bucket_width)
+
+  def _find_run(self, bin_size, first, last):
+    for run_first, depths in self.levels.get(bin_size, []):
+      if run_first <= first and last <= run_first + len(depths):
+        return run_first, depths
+    return None
+
+  def query(self, start, end, bin_size):
+    """Return (depth per bin, level bin size) for a window, or None.
+
+    The answer comes from the coarsest level no wider than bin_size that
+    covers the window, or failing that the finest level that does.
+    """
+    with self._lock:
+      sizes = sorted(self.levels, key=lambda size: (size > bin_size,
+                                                    abs(size - bin_size)))
+      for size in sizes:
+        first, last = start // size, (end + size - 1) // size
+        run = self._find_run(size, first, last)
+        if run:
+          run_first, depths = run
+          buckets = [{'range': {'start': i * size, 'end': (i + 1) * size},
+                      'meanCoverage': depths[i - run_first]}
+                     for i in range(first, last)]
+          return coverage.from_buckets(buckets, start, end, bin_size), size
+    return None
+
+  def to_json(self):
+    with self._lock:
+      return json.dumps({
+          'bucketWidths': list(self.bucket_widths),
+          'levels': dict((str(size), runs)
+                         for size, runs in self.levels.iteritems()),
+      })
+
+  @classmethod
+  def from_json(cls, text):
+    data = json.loads(text)
+    pyramid = cls()
+    pyramid.bucket_widths = set(data['bucketWidths'])
+    pyramid.levels = dict((int(size), runs)
+                          for size, runs in data['levels'].iteritems())
+    return pyramid
+
+
+class PyramidStore(object):
+  """Thread-safe LRU cache of pyramids by key, optionally persisted to disk"""
+
+  def __init__(self, directory=None, max_entries=MAX_ENTRIES):
+    self.directory = directory
+    self.max_entries = max_entries
+    self._lock = threading.Lock()
+    self._pyramids = collections.OrderedDict()
+
+    self.hits = 0
+    self.loads = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _get_path(self, key):
+    name = hashlib.sha1(json.dumps(key)).hexdigest()
+    return os.path.join(self.directory, name + '.json')
+
+  def get(self, key):
+    with self._lock:
+      pyramid = self._pyramids.pop(key, None)
+      if pyramid is not None:
+        # Re-insert to mark the pyramid as most recently used
+        self._pyramids[key] = pyramid
+        self.hits += 1
+        return pyramid
+      if not self.directory:
+        self.misses += 1
+        return None
+
+    path = self._get_path(key)
+    pyramid = None
+    if os.path.exists(path):
+      try:
+        with open(path) as f:
+          pyramid = CoveragePyramid.from_json(f.read())
+      except (IOError, ValueError, KeyError), err:
+        logging.warning('Ignoring unreadable coverage pyramid %s: %s',
+                        path, err)
+
+    with self._lock:
+      if pyramid is None:
+        self.misses += 1
+        return None
+      self.loads += 1
+      if key in self._pyramids:
+        # Another thread loaded it first
+        return self._pyramids[key]
+      self._store(key, pyramid)
+      return pyramid
+
+  def _store(self, key, pyramid):
+    self._pyramids.pop(key, None)
+    self._pyramids[key] = pyramid
+    while len(self._pyramids) > self.max_entries:
+      self._pyramids.popitem(last=False)
+      self.evictions += 1
+
+  def put(self, key, pyramid):
+    """Store a new or updated pyramid"""
+    with self._lock:
+      self._store(key, pyramid)
+    if not self.directory:
+      return
+
+    # Write to a temporary file first so readers never see a partial file
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      fd, temp_path = tempfile.mkstemp(dir=self.directory)
+      with os.fdopen(fd, 'w') as f:
+        f.write(pyramid.to_json())
+      os.rename(temp_path, self._get_path(key))
+    except (IOError, OSError), err:
+      logging.warning('Could not save coverage pyramid: %s', err)
+
+  def stats(self):
+    with self._lock:
+      return {
+          'entries': len(self._pyramids),
+          'hits': self.hits,
+          'loads': self.loads,
+          'misses': self.misses,
+          'evictions': self.evictions,
+      }
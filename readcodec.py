@@ -0,0 +1,207 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A compact columnar binary encoding for pages of reads.
+
+Clients opt in by sending the MEDIA_TYPE in their Accept header. The
+response is a sequence of frames, each a little-endian uint32 length
+followed by that many bytes. A frame is either a page or an error:
+
+  page:  'GAR1'
+         varint    read count (n)
+         string    nextPageToken ('' if there is none)
+         varint    reference name count, then that many strings
+         n strings id
+         n strings fragmentName
+         n bytes   flags (see FLAG_*)
+         for each read with a position:
+           varint  reference name index
+           varint  zigzag delta from the previous read's position
+           varint  mapping quality
+         for each read with a cigar:
+           varint  operation count, then per operation
+                   varint (operationLength << 4 | operation index), the
+                   index being 15 for unknown or missing operations
+         for each read with a mate position:
+           varint  reference name index
+           varint  zigzag delta from the read's own position
+         for each read with bases:
+           varint  base count, then the bases packed two per byte using
+                   the 4-bit BAM alphabet (first base in the high nibble)
+         for each read with qualities:
+           varint  quality count, then one byte per quality (255 if unset)
+
+  error: 'GERR'
+         string    message
+
+varints are unsigned LEB128, and strings are a varint byte length followed
+by UTF-8. The decoder lives in static/js/readgraph.js.
+"""
+
+import struct
+
+MEDIA_TYPE = 'application/x-gabrowse-reads'
+
+PAGE_MAGIC = 'GAR1'
+ERROR_MAGIC = 'GERR'
+
+FLAG_POSITION = 1
+FLAG_REVERSE_STRAND = 2
+FLAG_CIGAR = 4
+FLAG_MATE = 8
+FLAG_MATE_REVERSE_STRAND = 16
+FLAG_BASES = 32
+FLAG_QUALITIES = 64
+
+# The same order as the BAM format uses (MIDNSHP=X)
+CIGAR_OPERATIONS = [
+    'ALIGNMENT_MATCH', 'INSERT', 'DELETE', 'SKIP', 'CLIP_SOFT', 'CLIP_HARD',
+    'PAD', 'SEQUENCE_MATCH', 'SEQUENCE_MISMATCH'
+]
+_CIGAR_INDEXES = dict((op, i) for i, op in enumerate(CIGAR_OPERATIONS))
+
+# Stands in for operations missing from CIGAR_OPERATIONS
+UNKNOWN_CIGAR_INDEX = 15
+
+BASES = '=ACMGRSVTWYHKDBN'
+
+# Normalizes bases to the alphabet, mapping anything unknown to N
+_BASE_TABLE = ''.join(chr(i).upper() if chr(i).upper() in BASES else 'N'
+                      for i in range(256))
+
+# Maps each pair of bases (or a single trailing base) to its packed byte
+_BASE_PAIRS = dict((b1 + b2, chr(i1 << 4 | i2))
+                   for i1, b1 in enumerate(BASES)
+                   for i2, b2 in enumerate(BASES))
+_BASE_PAIRS.update((b, chr(i << 4)) for i, b in enumerate(BASES))
+
+
+def _write_varint(out, value):
+  while value > 0x7f:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+
+
+def _write_zigzag(out, value):
+  _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+
+
+def _write_string(out, value):
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  _write_varint(out, len(value))
+  out.extend(value)
+
+
+def _pack_bases(sequence):
+  sequence = sequence.encode('ascii', 'replace').translate(_BASE_TABLE)
+  return ''.join(_BASE_PAIRS[sequence[i:i + 2]]
+                 for i in xrange(0, len(sequence), 2))
+
+
+def frame(data):
+  """Prefix an encoded page or error with its length"""
+  return struct.pack('<I', len(data)) + data
+
+
+def encode_error(message):
+  out = bytearray(ERROR_MAGIC)
+  _write_string(out, message)
+  return frame(bytes(out))
+
+
+def encode_page(content):
+  """Encode a reads/search response as a page frame"""
+  reads = content.get('alignments', [])
+
+  out = bytearray(PAGE_MAGIC)
+  _write_varint(out, len(reads))
+  _write_string(out, content.get('nextPageToken', ''))
+
+  reference_names = []
+  reference_indexes = {}
+  def reference_index(name):
+    if name not in reference_indexes:
+      reference_indexes[name] = len(reference_names)
+      reference_names.append(name)
+    return reference_indexes[name]
+
+  flags = bytearray()
+  positions = bytearray()
+  cigars = bytearray()
+  mates = bytearray()
+  bases = bytearray()
+  qualities = bytearray()
+  previous_position = 0
+
+  for read in reads:
+    flag = 0
+    alignment = read.get('alignment') or {}
+    position = alignment.get('position')
+    read_position = previous_position
+    if position is not None:
+      flag |= FLAG_POSITION
+      if position.get('reverseStrand'):
+        flag |= FLAG_REVERSE_STRAND
+      read_position = int(position.get('position', 0))
+      _write_varint(positions, reference_index(position.get('referenceName',
+                                                            '')))
+      _write_zigzag(positions, read_position - previous_position)
+      _write_varint(positions, int(alignment.get('mappingQuality', 0)))
+      previous_position = read_position
+
+    cigar = alignment.get('cigar')
+    if cigar is not None:
+      flag |= FLAG_CIGAR
+      _write_varint(cigars, len(cigar))
+      for op in cigar:
+        _write_varint(cigars, int(op.get('operationLength', 0)) << 4 |
+                      _CIGAR_INDEXES.get(op.get('operation'),
+                                         UNKNOWN_CIGAR_INDEX))
+
+    mate = read.get('nextMatePosition')
+    if mate is not None:
+      flag |= FLAG_MATE
+      if mate.get('reverseStrand'):
+        flag |= FLAG_MATE_REVERSE_STRAND
+      _write_varint(mates, reference_index(mate.get('referenceName', '')))
+      _write_zigzag(mates, int(mate.get('position', 0)) - read_position)
+
+    sequence = read.get('alignedSequence')
+    if sequence is not None:
+      flag |= FLAG_BASES
+      _write_varint(bases, len(sequence))
+      bases.extend(_pack_bases(sequence))
+
+    quality = read.get('alignedQuality')
+    if quality is not None:
+      flag |= FLAG_QUALITIES
+      _write_varint(qualities, len(quality))
+      qualities.extend(q if 0 <= q < 255 else 255 for q in quality)
+
+    flags.append(flag)
+
+  _write_varint(out, len(reference_names))
+  for name in reference_names:
+    _write_string(out, name)
+  for read in reads:
+    _write_string(out, read.get('id', ''))
+  for read in reads:
+    _write_string(out, read.get('fragmentName', ''))
+  for column in (flags, positions, cigars, mates, bases, qualities):
+    out.extend(column)
+
+  return frame(bytes(out))
@@ -0,0 +1,172 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A persistent cache of SNPedia page content.
+
+Pages are stored in a SQLite database keyed by their normalized title, so
+they survive restarts. Pages which don't exist are cached too (as MISSING),
+usually for less time. When the stored content grows past a size cap, the
+least recently used pages are evicted.
+
+Lookups only read the database. When a page was last marked used more than
+USED_RESOLUTION seconds ago, the new time is kept in memory and written
+with the next page stored, before anything is evicted.
+"""
+
+import logging
+import os
+import threading
+import time
+
+try:
+  import sqlite3
+except ImportError:
+  sqlite3 = None
+
+# Returned by PageCache.get for pages known not to exist
+MISSING = object()
+
+# How out of date a page's last use may be in the database, in seconds
+USED_RESOLUTION = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+  title TEXT PRIMARY KEY,
+  content TEXT,
+  size INTEGER NOT NULL,
+  expires REAL NOT NULL,
+  used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_used ON pages (used);
+"""
+
+
+def normalize_title(title):
+  """Normalize a page title the way MediaWiki does"""
+  title = title.strip().replace(' ', '_')
+  return title[:1].upper() + title[1:]
+
+
+class PageCache(object):
+  """A thread-safe, size-capped SQLite cache of page content by title"""
+
+  def __init__(self, path, ttl, missing_ttl, max_bytes):
+    self.path = path
+    self.ttl = ttl
+    self.missing_ttl = missing_ttl
+    self.max_bytes = max_bytes
+
+    self._lock = threading.Lock()
+    self._db = None
+    self._bytes = 0
+    # Titles whose last use is yet to be written -> time of that use
+    self._used = {}
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _connect(self):
+    # Connect on first use, so that importing main.py doesn't touch the disk
+    if self._db is None:
+      directory = os.path.dirname(self.path)
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+      db = sqlite3.connect(self.path, check_same_thread=False)
+      db.executescript(_SCHEMA)
+      self._bytes = db.execute(
+          'SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+      self._db = db
+    return self._db
+
+  def get(self, title):
+    """Return the content of a page, MISSING, or None if not cached"""
+    title = normalize_title(title)
+    now = time.time()
+    try:
+      with self._lock:
+        db = self._connect()
+        row = db.execute(
+            'SELECT content, expires, used FROM pages WHERE title = ?',
+            (title,)).fetchone()
+        if row is None or row[1] < now:
+          self.misses += 1
+          return None
+
+        if now - row[2] >= USED_RESOLUTION:
+          self._used[title] = now
+        self.hits += 1
+    except (sqlite3.Error, OSError), err:
+      logging.warning('SNPedia cache lookup failed: %s', err)
+      return None
+
+    return MISSING if row[0] is None else row[0]
+
+  def put(self, title, content):
+    """Store the content of a page, or MISSING"""
+    title = normalize_title(title)
+    now = time.time()
+    if content is MISSING:
+      content, size, ttl = None, 0, self.missing_ttl
+    else:
+      size, ttl = len(content), self.ttl
+    if ttl <= 0 or size > self.max_bytes:
+      return
+
+    try:
+      with self._lock:
+        db = self._connect()
+        with db:
+          old = db.execute('SELECT size FROM pages WHERE title = ?',
+                           (title,)).fetchone()
+          db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                     (title, content, size, now + ttl, now))
+          self._used.pop(title, None)
+          self._write_used(db)
+          self._bytes += size - (old[0] if old else 0)
+
+          if self._bytes > self.max_bytes:
+            self._evict(db)
+    except (sqlite3.Error, OSError), err:
+      logging.warning('SNPedia cache update failed: %s', err)
+
+  def _write_used(self, db):
+    if self._used:
+      db.executemany('UPDATE pages SET used = ? WHERE title = ?',
+                     [(used, title) for title, used in self._used.iteritems()])
+      self._used.clear()
+
+  def _evict(self, db):
+    # Drop expired pages first, then the least recently used ones
+    db.execute('DELETE FROM pages WHERE expires < ?', (time.time(),))
+    self._bytes = db.execute(
+        'SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+    rows = db.execute('SELECT title, size FROM pages ORDER BY used').fetchall()
+    for title, size in rows:
+      if self._bytes <= self.max_bytes:
+        break
+      db.execute('DELETE FROM pages WHERE title = ?', (title,))
+      self._bytes -= size
+      self.evictions += 1
+
+  def stats(self):
+    with self._lock:
+      return {
+          'bytes': self._bytes,
+          'max_bytes': self.max_bytes,
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+      }
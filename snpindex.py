@@ -0,0 +1,223 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+An offline index of SNP positions, so SNP searches don't need SNPedia.
+
+The index is built from a tab-separated dump with one SNP per line:
+
+  rsid  chromosome  position  [gene]
+
+(lines starting with # are ignored, and the dump may be gzipped) with:
+
+  python snpindex.py dump.tsv[.gz] snpindex.bin
+
+The index file is laid out as:
+
+  header      '<4sIII': 'SNI2', SNP count, chromosome count, gene count
+  chromosomes uint8 length and name of each chromosome
+  SNPs        '<IHII' per SNP, sorted by rs number: rs number, chromosome
+              index, position, gene index (NO_GENE if there is none)
+  genes       uint8 length, name and '<II' (first member, member count) per
+              gene, sorted by name
+  members     uint32 SNP index per gene member, grouped by gene
+
+Names are UTF-8, cut to the last whole character within 255 bytes. SNPs
+are found by binary search over the fixed-size records, and genes by
+binary search over their names.
+"""
+
+import bisect
+import gzip
+import re
+import struct
+import sys
+
+MAGIC = 'SNI2'
+
+_HEADER = struct.Struct('<4sIII')
+_RECORD = struct.Struct('<IHII')
+_GENE = struct.Struct('<II')
+_MEMBER = struct.Struct('<I')
+
+NO_GENE = 0xffffffff
+
+_RSID = re.compile(r'^rs(\d+)$', re.I)
+
+
+def parse_rsid(name):
+  """Return the number of an rsID like rs123, or None"""
+  match = _RSID.match(name.strip())
+  return int(match.group(1)) if match else None
+
+
+class SnpIndex(object):
+  """A read-only SNP index, held in memory as the raw index file"""
+
+  def __init__(self, data):
+    magic, self.count, chromosome_count, gene_count = \
+        _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+      raise ValueError('Not a SNP index')
+    self._data = data
+
+    offset = _HEADER.size
+    self.chromosomes = []
+    for _ in xrange(chromosome_count):
+      offset, name = self._read_name(offset)
+      self.chromosomes.append(name)
+
+    self._records = offset
+    offset += self.count * _RECORD.size
+
+    self.genes = []
+    self._gene_members = []
+    for _ in xrange(gene_count):
+      offset, name = self._read_name(offset)
+      self.genes.append(name)
+      self._gene_members.append(_GENE.unpack_from(data, offset))
+      offset += _GENE.size
+    self._members = offset
+    self._gene_keys = [gene.upper() for gene in self.genes]
+
+  @classmethod
+  def load(cls, path):
+    with open(path, 'rb') as f:
+      return cls(f.read())
+
+  def _read_name(self, offset):
+    length = ord(self._data[offset])
+    return (offset + 1 + length,
+            self._data[offset + 1:offset + 1 + length].decode('utf-8'))
+
+  def _get_record(self, index):
+    return _RECORD.unpack_from(self._data,
+                               self._records + index * _RECORD.size)
+
+  def _to_snp(self, record):
+    number, chromosome, position, gene = record
+    return {
+        'name': 'rs%d' % number,
+        'chr': self.chromosomes[chromosome],
+        'position': str(position),
+        'gene': self.genes[gene] if gene != NO_GENE else None,
+    }
+
+  def find_snp(self, name):
+    """Return the SNP with an rsID, or None"""
+    number = parse_rsid(name)
+    if number is None:
+      return None
+
+    low, high = 0, self.count
+    while low < high:
+      middle = (low + high) // 2
+      record = self._get_record(middle)
+      if record[0] < number:
+        low = middle + 1
+      elif record[0] > number:
+        high = middle
+      else:
+        return self._to_snp(record)
+    return None
+
+  def find_gene(self, name):
+    """Return the SNPs in a gene (matched case insensitively)"""
+    key = name.strip().upper()
+    index = bisect.bisect_left(self._gene_keys, key)
+    if index == len(self._gene_keys) or self._gene_keys[index] != key:
+      return []
+
+    first, count = self._gene_members[index]
+    snps = []
+    for i in xrange(first, first + count):
+      member, = _MEMBER.unpack_from(self._data,
+                                    self._members + i * _MEMBER.size)
+      snps.append(self._to_snp(self._get_record(member)))
+    return snps
+
+
+def build(lines):
+  """Build the contents of an index file from lines of a dump"""
+  snps = {}
+  for line in lines:
+    if not line.strip() or line.startswith('#'):
+      continue
+    fields = line.rstrip('\r\n').split('\t')
+    number = parse_rsid(fields[0])
+    if number is None or len(fields) < 3 or not fields[2].strip():
+      continue
+    gene = fields[3].strip() if len(fields) > 3 else ''
+    snps[number] = (fields[1].strip(), int(fields[2]), gene)
+
+  chromosomes = sorted(set(snp[0] for snp in snps.itervalues()))
+  chromosome_indexes = dict((c, i) for i, c in enumerate(chromosomes))
+  # Genes are matched case insensitively, keeping the first spelling seen
+  gene_names = {}
+  for number in sorted(snps):
+    gene = snps[number][2]
+    if gene:
+      gene_names.setdefault(gene.upper(), gene)
+  genes = [gene_names[key] for key in sorted(gene_names)]
+  gene_indexes = dict((g.upper(), i) for i, g in enumerate(genes))
+
+  numbers = sorted(snps)
+  members = [[] for _ in genes]
+  out = [_HEADER.pack(MAGIC, len(numbers), len(chromosomes), len(genes))]
+  for chromosome in chromosomes:
+    out.append(_pack_name(chromosome))
+  for index, number in enumerate(numbers):
+    chromosome, position, gene = snps[number]
+    gene_index = gene_indexes[gene.upper()] if gene else NO_GENE
+    if gene:
+      members[gene_index].append(index)
+    out.append(_RECORD.pack(number, chromosome_indexes[chromosome], position,
+                            gene_index))
+
+  first = 0
+  for gene, gene_members in zip(genes, members):
+    out.append(_pack_name(gene))
+    out.append(_GENE.pack(first, len(gene_members)))
+    first += len(gene_members)
+  for gene_members in members:
+    out.extend(_MEMBER.pack(member) for member in gene_members)
+  return ''.join(out)
+
+
+def _pack_name(name):
+  if not isinstance(name, unicode):
+    name = name.decode('utf-8', 'replace')
+  name = name.encode('utf-8')
+  if len(name) > 255:
+    # Drop whatever is left of a character cut in two
+    name = name[:255].decode('utf-8', 'ignore').encode('utf-8')
+  return chr(len(name)) + name
+
+
+def main(argv):
+  if len(argv) != 3:
+    sys.stderr.write('Usage: %s DUMP INDEX\n' % argv[0])
+    return 1
+
+  opener = gzip.open if argv[1].endswith('.gz') else open
+  with opener(argv[1], 'rb') as f:
+    data = build(f)
+  with open(argv[2], 'wb') as f:
+    f.write(data)
+  print 'Wrote %d SNPs to %s' % (SnpIndex(data).count, argv[2])
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
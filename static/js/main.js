@@ -18,6 +18,12 @@ limitations under the License.
 var CALLSET_TYPE = "CALLSET";
 var READSET_TYPE = "READSET";
 
+// The fingerprinted URL of an image, if the static files have been built
+// (imageUrls is set by main.html)
+function imageUrl(name) {
+  return imageUrls['img/' + name] || '/static/img/' + name;
+}
+
 function toggleUi(clazz, link) {
   $(".toggleable").hide();
   $("." + clazz).show();
@@ -61,11 +67,15 @@ function getBackendName(backend) {
 }
 
 var loadedSetData = {};
+var loadingSets = {};
 function loadSet(readsetBackend, readsetIds, callsetBackends, callsetIds,
     opt_location, setType, id, backend) {
   if (_.has(loadedSetData, id)) {
     return false;
   }
+  if (_.has(loadingSets, id)) {
+    return true;
+  }
 
   if (!backend) {
     showError('Backend for ' + id + ' isn\'t specified. ' +
@@ -75,7 +85,11 @@ function loadSet(readsetBackend, readsetIds, callsetBackends, callsetIds,
 
   showMessage('Loading data');
 
+  loadingSets[id] = true;
   $.getJSON('/api/sets', {backend: backend, setType: setType, setId: id})
+    .always(function() {
+      delete loadingSets[id];
+    })
     .done(function(res) {
       var sequenceData = _.sortBy(res.references,
         function(ref) { return parseInt(ref.name); });
@@ -89,22 +103,20 @@ function loadSet(readsetBackend, readsetIds, callsetBackends, callsetIds,
 
 function updateSets(readsetBackend, readsetIds, callsetBackends, callsetIds,
     opt_location) {
-  // Load missing readsets
+  // Load all the missing readsets and callsets at once
+  var loading = false;
   for (var i = 0; i < readsetIds.length; i++) {
-    if (loadSet(readsetBackend, readsetIds, callsetBackends, callsetIds,
-        opt_location, READSET_TYPE, readsetIds[i], readsetBackend)) {
-      // Wait for the set to callback
-      return;
-    }
+    loading = loadSet(readsetBackend, readsetIds, callsetBackends, callsetIds,
+        opt_location, READSET_TYPE, readsetIds[i], readsetBackend) || loading;
   }
-
-  // Load missing callsets
   for (var j = 0; j < callsetIds.length; j++) {
-    if (loadSet(readsetBackend, readsetIds, callsetBackends, callsetIds,
-        opt_location, CALLSET_TYPE, callsetIds[j], callsetBackends[j])) {
-      // Wait for the set to callback
-      return;
-    }
+    loading = loadSet(readsetBackend, readsetIds, callsetBackends, callsetIds,
+        opt_location, CALLSET_TYPE, callsetIds[j], callsetBackends[j]) ||
+        loading;
+  }
+  if (loading) {
+    // Wait for the sets to callback
+    return;
   }
 
   updateListItems(READSET_TYPE, readsetIds, loadedSetData);
@@ -167,7 +179,7 @@ function setSearchTab(setType) {
 function searchSetsOfType(button, setType, backend, datasetId) {
   var tabPane = $('#searchPane' + setType);
   var div = tabPane.find('.results')
-    .html('<img src="static/img/spinner.gif"/>');
+    .html($('<img>').attr('src', imageUrl('spinner.gif')));
 
   function getItemsOnPage(page) {
     return div.find('.list-group-item[page=' + page + ']');
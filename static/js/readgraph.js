@@ -358,7 +358,7 @@ var readgraph = new function() {
 
   var addImage = function(parent, name, width, height, x, y,
       opt_handler, opt_class) {
-    return parent.append('image').attr('xlink:href', '/static/img/' + name)
+    return parent.append('image').attr('xlink:href', imageUrl(name))
         .attr('width', width).attr('height', height)
         .attr('x', x).attr('y', y)
         .on("mouseup", opt_handler || function(){})
@@ -402,7 +402,7 @@ var readgraph = new function() {
   };
 
   var makeImageUrl = function(name) {
-    return '/static/img/' + name + '.png';
+    return imageUrl(name + '.png');
   };
 
   var getSequenceName = function(sequence) {
@@ -690,10 +690,13 @@ var readgraph = new function() {
     var call = variant.calls[data.callIndex];
 
     var name = variant.names ? variant.names.join(" ") : "";
+    var allele = alleleSummaries[data.alleles];
 
     showObject(this, variantDiv, "Variant: " + name, [
       ["Call set name", call.callSetName],
       ["Genotype", getGenotype(variant, call)],
+      ["SNPedia", allele && allele.summary ?
+          allele.repute + ' - ' + allele.summary : null],
       ["Reference name", variant.referenceName],
       ["Reference bases", variant.referenceBases],
       ["Start", variant.start],
@@ -722,6 +725,43 @@ var readgraph = new function() {
     return genotype;
   };
 
+  // SNPedia genotype summaries keyed by 'snp:a1:a2', which are looked up in
+  // bulk for the variants in view
+  var alleleSummaries = {};
+  var MAX_ALLELES_PER_REQUEST = 100;
+
+  var getVariantAlleles = function(variant, call) {
+    var snp = _.find(variant.names || [], function(name) {
+      return /^rs\d+$/i.test(name);
+    });
+    var genotype = getGenotype(variant, call);
+    if (!snp || genotype.length != 2 ||
+        genotype[0].length != 1 || genotype[1].length != 1) {
+      return null;
+    }
+    return [snp, genotype[0], genotype[1]].join(':');
+  };
+
+  var loadAlleleSummaries = function(data) {
+    var keys = _.uniq(_.compact(_.pluck(data, 'alleles')));
+    keys = _.reject(keys, function(key) { return _.has(alleleSummaries, key); });
+
+    for (var i = 0; i < keys.length; i += MAX_ALLELES_PER_REQUEST) {
+      var batch = keys.slice(i, i + MAX_ALLELES_PER_REQUEST);
+      _.each(batch, function(key) { alleleSummaries[key] = null; });
+      $.getJSON('/api/alleles', {alleles: batch.join(',')})
+          .done(_.partial(function(batch, res) {
+            _.each(batch, function(key, j) {
+              alleleSummaries[key] = res.alleles[j];
+            });
+          }, batch))
+          .fail(_.partial(function(batch) {
+            // Forget the batch so the next draw asks for it again
+            _.each(batch, function(key) { delete alleleSummaries[key]; });
+          }, batch));
+    }
+  };
+
   var setVariants = function(variants) {
     var data = [];
     var maxCalls = 0;
@@ -735,6 +775,7 @@ var readgraph = new function() {
           rx: variant.start,
           ry: callIndex,
           genotype: getGenotype(variant, call).join(";"),
+          alleles: getVariantAlleles(variant, call),
           variant: variant,
           callIndex: callIndex
           // TODO: Use likelihood for opacity
@@ -757,6 +798,8 @@ var readgraph = new function() {
 
     var baseView = getScaleLevel() > 5;
     if (baseView) {
+      loadAlleleSummaries(data);
+
       var bases = variantDivs.selectAll(".letter")
           .data(function(variant, i) { return [variant];});
 
@@ -933,6 +976,7 @@ var readgraph = new function() {
       return;
     }
 
+    startTrace();
     var desiredStart = start - windowSize * MAX_CACHE_FACTOR;
     desiredStart = clamp(desiredStart, 1, currentSequence.length);
     var desiredEnd = end + windowSize * MAX_CACHE_FACTOR;
@@ -960,7 +1004,11 @@ var readgraph = new function() {
   var queryReadData = function(start, end, bases) {
     var readParams = makeQueryParams(start, end, READSET_TYPE, bases);
     if (readParams) {
-      callXhr('/api/reads', readParams, updateReads);
+      if (supportsColumnarReads) {
+        callColumnarFetch('/api/reads', readParams, updateReads);
+      } else {
+        callStreamingXhr('/api/reads', readParams, updateReads);
+      }
     }
   };
 
@@ -972,6 +1020,17 @@ var readgraph = new function() {
   };
 
 
+  // Every API request carries an X-Request-Id, which the server logs with
+  // its timings. The requests for one pan or zoom share a prefix, so that
+  // they can be found together.
+  var traceSession = Math.random().toString(16).substring(2, 8);
+  var tracePrefix = traceSession + '-0';
+  var traceCount = 0;
+  var requestCount = 0;
+  var startTrace = function() {
+    tracePrefix = traceSession + '-' + (++traceCount);
+  };
+
   var pendingLoads = 0;
   var totalLoads = 0;
   var startLoadMonitor = function() {
@@ -980,7 +1039,9 @@ var readgraph = new function() {
     }
     pendingLoads++;
     var loadIndex = totalLoads++;
-    var timeLabel = 'readgraph load[' + loadIndex + ']';
+    // Continuation requests stay in the trace of the load they belong to
+    var prefix = tracePrefix;
+    var timeLabel = 'readgraph load[' + loadIndex + '] ' + prefix;
     if ('time' in console) {
       console.time(timeLabel);
     }
@@ -989,7 +1050,7 @@ var readgraph = new function() {
     }
 
     // Callers should invoke this callback on completion
-    return function() {
+    var onComplete = function() {
       pendingLoads--;
       if (!pendingLoads) {
         spinner.style('display', 'none');
@@ -1001,14 +1062,31 @@ var readgraph = new function() {
         console.timeStamp(timeLabel + ' finish');
       }
     };
+
+    onComplete.nextRequestId = function() {
+      return prefix + '.' + (requestCount++);
+    };
+    return onComplete;
   };
 
   var totalReadBytes = 0;
   var callXhr = function(url, queryParams, handler, opt_monitor, opt_data) {
     var onComplete = opt_monitor || startLoadMonitor();
-    $.getJSON(url, queryParams)
+    $.ajax({
+      url: url,
+      data: queryParams,
+      dataType: 'json',
+      headers: {'X-Request-Id': onComplete.nextRequestId()}
+    })
         .done(function(res, status, jqXHR) {
           var data;
+          if (res.error) {
+            // The server hit an error after it started sending the response
+            showError('Sorry, the api request failed for some reason. ' +
+                '(' + res.error + ')');
+            onComplete();
+            return;
+          }
           if (res.alignments) {
             var len = parseInt(jqXHR.getResponseHeader('Content-Length'));
             totalReadBytes += len;
@@ -1035,6 +1113,284 @@ var readgraph = new function() {
         });
   };
 
+  // Reads are requested with drain=true, so the server follows the page
+  // tokens itself and streams each page back as a line of JSON. Pages are
+  // handled as they arrive. If the server stops early (it has a size budget),
+  // the last page still has a nextPageToken and we continue from there.
+  var callStreamingXhr = function(url, queryParams, handler, opt_monitor) {
+    var onComplete = opt_monitor || startLoadMonitor();
+    var xhr = new XMLHttpRequest();
+    var offset = 0;
+    var nextPageToken = null;
+    var failed = false;
+
+    var handleLines = function() {
+      var text = xhr.responseText;
+      for (var end = text.indexOf('\n', offset); end >= 0;
+           end = text.indexOf('\n', offset)) {
+        var len = end + 1 - offset;
+        var res = JSON.parse(text.substring(offset, end));
+        offset = end + 1;
+
+        if (res.error) {
+          failed = true;
+          showError('Sorry, the api request failed for some reason. ' +
+              '(' + res.error + ')');
+          continue;
+        }
+
+        totalReadBytes += len;
+        console.log('readgraph ' + res.alignments.length
+          + (res.alignments.length && 'alignedSequence' in res.alignments[0] ? ' full' : ' partial')
+          + ' reads (' + Math.round(len/1024) + 'kb), total ' + Math.round(totalReadBytes/1024) + 'kb');
+        handler(res.alignments);
+        nextPageToken = res.nextPageToken;
+      }
+    };
+
+    xhr.onprogress = handleLines;
+    xhr.onload = function() {
+      if (xhr.status != 200) {
+        showError('Sorry, the api request failed for some reason. ' +
+            '(' + xhr.responseText + ')');
+        onComplete();
+        return;
+      }
+
+      handleLines();
+      if (nextPageToken && !failed) {
+        queryParams['pageToken'] = nextPageToken;
+        callStreamingXhr(url, queryParams, handler, onComplete);
+      } else {
+        onComplete();
+      }
+    };
+    xhr.onerror = function() {
+      onComplete();
+    };
+
+    xhr.open('GET', url + '?' + $.param(_.extend({drain: true}, queryParams)));
+    xhr.setRequestHeader('X-Request-Id', onComplete.nextRequestId());
+    xhr.send();
+  };
+
+  // The columnar binary read encoding (see readcodec.py) needs streaming
+  // fetch support to be read as it arrives. Other browsers use JSON.
+  var READS_MEDIA_TYPE = 'application/x-gabrowse-reads';
+  var supportsColumnarReads = 'fetch' in window && 'ReadableStream' in window
+      && 'TextDecoder' in window;
+
+  var CIGAR_OPERATIONS = ['ALIGNMENT_MATCH', 'INSERT', 'DELETE', 'SKIP',
+    'CLIP_SOFT', 'CLIP_HARD', 'PAD', 'SEQUENCE_MATCH', 'SEQUENCE_MISMATCH'];
+  var PACKED_BASES = '=ACMGRSVTWYHKDBN';
+
+  var FLAG_POSITION = 1;
+  var FLAG_REVERSE_STRAND = 2;
+  var FLAG_CIGAR = 4;
+  var FLAG_MATE = 8;
+  var FLAG_MATE_REVERSE_STRAND = 16;
+  var FLAG_BASES = 32;
+  var FLAG_QUALITIES = 64;
+
+  // Decodes one frame (without its length prefix) into the same shape as
+  // the JSON /api/reads response, or {error: message}.
+  var decodeReadPage = function(bytes) {
+    var offset = 4;
+    var utf8 = new TextDecoder('utf-8');
+
+    var readVarint = function() {
+      // Avoid bitwise operators, which would truncate to 32 bits
+      var value = 0, multiplier = 1, b;
+      do {
+        b = bytes[offset++];
+        value += (b & 0x7f) * multiplier;
+        multiplier *= 128;
+      } while (b & 0x80);
+      return value;
+    };
+    var readZigzag = function() {
+      var value = readVarint();
+      return value % 2 ? -(value + 1) / 2 : value / 2;
+    };
+    var readString = function() {
+      var length = readVarint();
+      offset += length;
+      return utf8.decode(bytes.subarray(offset - length, offset));
+    };
+
+    var magic = String.fromCharCode(bytes[0], bytes[1], bytes[2], bytes[3]);
+    if (magic == 'GERR') {
+      return {error: readString()};
+    }
+
+    var count = readVarint();
+    var page = {alignments: []};
+    var nextPageToken = readString();
+    if (nextPageToken) {
+      page.nextPageToken = nextPageToken;
+    }
+
+    var referenceNames = [];
+    for (var i = 0, n = readVarint(); i < n; i++) {
+      referenceNames.push(readString());
+    }
+
+    var reads = page.alignments;
+    for (i = 0; i < count; i++) {
+      var id = readString();
+      reads.push(id ? {id: id} : {});
+    }
+    for (i = 0; i < count; i++) {
+      var fragmentName = readString();
+      if (fragmentName) {
+        reads[i].fragmentName = fragmentName;
+      }
+    }
+
+    var flags = bytes.subarray(offset, offset + count);
+    offset += count;
+
+    var positions = [];
+    var position = 0;
+    for (i = 0; i < count; i++) {
+      if (flags[i] & FLAG_POSITION) {
+        var referenceName = referenceNames[readVarint()];
+        position += readZigzag();
+        reads[i].alignment = {
+          position: {
+            referenceName: referenceName,
+            position: position,
+            reverseStrand: !!(flags[i] & FLAG_REVERSE_STRAND)
+          },
+          mappingQuality: readVarint()
+        };
+      }
+      positions.push(position);
+    }
+
+    for (i = 0; i < count; i++) {
+      if (flags[i] & FLAG_CIGAR) {
+        var cigar = [];
+        for (var c = 0, ops = readVarint(); c < ops; c++) {
+          var op = readVarint();
+          cigar.push({
+            operation: CIGAR_OPERATIONS[op % 16] || 'OPERATION_UNSPECIFIED',
+            operationLength: Math.floor(op / 16)
+          });
+        }
+        reads[i].alignment = reads[i].alignment || {};
+        reads[i].alignment.cigar = cigar;
+      }
+    }
+
+    for (i = 0; i < count; i++) {
+      if (flags[i] & FLAG_MATE) {
+        reads[i].nextMatePosition = {
+          referenceName: referenceNames[readVarint()],
+          position: positions[i] + readZigzag(),
+          reverseStrand: !!(flags[i] & FLAG_MATE_REVERSE_STRAND)
+        };
+      }
+    }
+
+    for (i = 0; i < count; i++) {
+      if (flags[i] & FLAG_BASES) {
+        var baseCount = readVarint();
+        var bases = new Array(baseCount);
+        for (var b = 0; b < baseCount; b++) {
+          var packed = bytes[offset + (b >> 1)];
+          bases[b] = PACKED_BASES.charAt(b % 2 ? packed & 0xf : packed >> 4);
+        }
+        offset += Math.ceil(baseCount / 2);
+        reads[i].alignedSequence = bases.join('');
+      }
+    }
+
+    for (i = 0; i < count; i++) {
+      if (flags[i] & FLAG_QUALITIES) {
+        var qualityCount = readVarint();
+        reads[i].alignedQuality = Array.prototype.slice.call(
+            bytes.subarray(offset, offset + qualityCount));
+        offset += qualityCount;
+      }
+    }
+
+    return page;
+  };
+
+  // Like callStreamingXhr, but asks for the columnar encoding and decodes
+  // each length-prefixed frame as soon as it has fully arrived.
+  var callColumnarFetch = function(url, queryParams, handler, opt_monitor) {
+    var onComplete = opt_monitor || startLoadMonitor();
+    var nextPageToken = null;
+    var buffer = new Uint8Array(0);
+
+    var handleFrames = function() {
+      while (buffer.length >= 4) {
+        var len = new DataView(buffer.buffer, buffer.byteOffset, 4)
+            .getUint32(0, true);
+        if (buffer.length < 4 + len) {
+          break;
+        }
+
+        var page = decodeReadPage(buffer.subarray(4, 4 + len));
+        buffer = buffer.subarray(4 + len);
+        if (page.error) {
+          throw new Error(page.error);
+        }
+
+        totalReadBytes += 4 + len;
+        console.log('readgraph ' + page.alignments.length
+          + (page.alignments.length && 'alignedSequence' in page.alignments[0] ? ' full' : ' partial')
+          + ' reads (' + Math.round(len/1024) + 'kb binary), total ' + Math.round(totalReadBytes/1024) + 'kb');
+        handler(page.alignments);
+        nextPageToken = page.nextPageToken;
+      }
+    };
+
+    fetch(url + '?' + $.param(_.extend({drain: true}, queryParams)), {
+      credentials: 'same-origin',
+      headers: {
+        'Accept': READS_MEDIA_TYPE,
+        'X-Request-Id': onComplete.nextRequestId()
+      }
+    }).then(function(response) {
+      if (!response.ok) {
+        return response.text().then(function(text) {
+          throw new Error(text);
+        });
+      }
+
+      var reader = response.body.getReader();
+      var pump = function() {
+        return reader.read().then(function(result) {
+          if (result.done) {
+            return;
+          }
+          var joined = new Uint8Array(buffer.length + result.value.length);
+          joined.set(buffer);
+          joined.set(result.value, buffer.length);
+          buffer = joined;
+          handleFrames();
+          return pump();
+        });
+      };
+      return pump();
+
+    }).then(function() {
+      if (nextPageToken) {
+        queryParams['pageToken'] = nextPageToken;
+        callColumnarFetch(url, queryParams, handler, onComplete);
+      } else {
+        onComplete();
+      }
+    }, function(error) {
+      showError('Sorry, the api request failed for some reason. ' +
+          '(' + error.message + ')');
+      onComplete();
+    });
+  };
+
   this.updateSets = function(setData) {
     if (_.isEqual(setObjects, setData)) {
       return;
@@ -0,0 +1,239 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Building and serving the static assets.
+
+Running this file copies everything under static/ into static/dist/, both
+under its own name and under a name with a hash of its content in it (so
+js/main.js also becomes js/main.0123456789.js), and writes gzip (and, if
+the brotli module is installed, brotli) compressed variants of text files
+next to them. static_manifest.json, next to static/, maps each original
+path to its fingerprinted one, which is what the static_url template
+function uses. It is kept outside static/ because App Engine uploads the
+files its static handlers serve as static data only, which the app itself
+can't read.
+
+Fingerprinted files never change, so they are served as immutable.
+StaticApp serves them (and the rest of static/) for localserver.py, with
+strong ETags and the precompressed variants; app.yaml does the same on App
+Engine.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+import time
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST = 'static_manifest.json'
+
+# Files with these extensions get compressed variants
+COMPRESSED_EXTENSIONS = frozenset([
+    '.css', '.js', '.json', '.svg', '.ttf', '.eot', '.txt', '.html'
+])
+
+# The variants StaticApp will serve, in order of preference
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+BLOCK_SIZE = 64 * 1024
+
+_FINGERPRINTED = re.compile(r'\.[0-9a-f]{10}(\.[^./]+)?$')
+
+mimetypes.add_type('application/font-woff', '.woff')
+mimetypes.add_type('application/vnd.ms-fontobject', '.eot')
+mimetypes.add_type('image/svg+xml', '.svg')
+
+
+def get_hash(path):
+  with open(path, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def fingerprint(name, content_hash):
+  base, extension = os.path.splitext(name)
+  return '%s.%s%s' % (base, content_hash[:10], extension)
+
+
+def get_manifest_path(static_dir):
+  return os.path.join(os.path.dirname(os.path.abspath(static_dir)), MANIFEST)
+
+
+def load_manifest(static_dir):
+  """Return the manifest of a built static directory, or {} if unbuilt"""
+  try:
+    with open(get_manifest_path(static_dir)) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+
+def make_static_url(manifest, prefix='/static/'):
+  """Make the static_url template function for a manifest"""
+  def static_url(path):
+    if path in manifest:
+      return '%s%s/%s' % (prefix, DIST_DIR, manifest[path])
+    return prefix + path
+  return static_url
+
+
+def _compress(path):
+  with open(path, 'rb') as f:
+    data = f.read()
+  with open(path + '.gz', 'wb') as raw:
+    # A fixed mtime keeps the output the same between builds
+    with gzip.GzipFile(os.path.basename(path), 'wb', 9, raw, 0) as f:
+      f.write(data)
+  if brotli is not None:
+    with open(path + '.br', 'wb') as f:
+      f.write(brotli.compress(data))
+
+
+def build(static_dir):
+  """Build static_dir/dist from the rest of static_dir"""
+  dist_dir = os.path.join(static_dir, DIST_DIR)
+  if os.path.isdir(dist_dir):
+    shutil.rmtree(dist_dir)
+
+  manifest = {}
+  for directory, subdirectories, files in os.walk(static_dir):
+    if directory == static_dir and DIST_DIR in subdirectories:
+      subdirectories.remove(DIST_DIR)
+    for name in files:
+      source = os.path.join(directory, name)
+      path = os.path.relpath(source, static_dir).replace(os.sep, '/')
+      manifest[path] = fingerprint(path, get_hash(source))
+
+      # Plain copies keep relative references (like CSS to fonts) working
+      for target_path in (path, manifest[path]):
+        target = os.path.join(dist_dir, target_path)
+        if not os.path.isdir(os.path.dirname(target)):
+          os.makedirs(os.path.dirname(target))
+        shutil.copy2(source, target)
+        if os.path.splitext(name)[1] in COMPRESSED_EXTENSIONS:
+          _compress(target)
+
+  with open(get_manifest_path(static_dir), 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  return manifest
+
+
+class StaticApp(object):
+  """A WSGI app serving a static directory (see the module docstring)"""
+
+  def __init__(self, static_dir):
+    self.static_dir = os.path.abspath(static_dir)
+    # path -> (mtime, size, etag)
+    self._etags = {}
+
+  def _get_etag(self, path):
+    stat = os.stat(path)
+    cached = self._etags.get(path)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+      return cached[2]
+    etag = get_hash(path)
+    self._etags[path] = (stat.st_mtime, stat.st_size, etag)
+    return etag
+
+  def _error(self, start_response, status):
+    start_response(status, [('Content-Type', 'text/plain')])
+    return [status]
+
+  def __call__(self, environ, start_response):
+    if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+      return self._error(start_response, '405 Method Not Allowed')
+
+    path = os.path.normpath(os.path.join(
+        self.static_dir, environ.get('PATH_INFO', '').lstrip('/')))
+    if (not path.startswith(self.static_dir + os.sep) or
+        not os.path.isfile(path)):
+      return self._error(start_response, '404 Not Found')
+
+    content_type, _ = mimetypes.guess_type(path)
+    fingerprinted = (os.sep + DIST_DIR + os.sep in path and
+                     _FINGERPRINTED.search(path))
+    headers = [
+        ('Content-Type', content_type or 'application/octet-stream'),
+        ('Cache-Control', IMMUTABLE if fingerprinted else REVALIDATE),
+    ]
+
+    # Serve a precompressed variant when the client accepts one
+    accepted = environ.get('HTTP_ACCEPT_ENCODING', '')
+    served_path = path
+    etag = self._get_etag(path)
+    if any(os.path.exists(path + suffix) for _, suffix in ENCODINGS):
+      headers.append(('Vary', 'Accept-Encoding'))
+      for encoding, suffix in ENCODINGS:
+        if encoding in accepted and os.path.exists(path + suffix):
+          served_path = path + suffix
+          etag += '-' + encoding
+          headers.append(('Content-Encoding', encoding))
+          break
+    headers.append(('ETag', '"%s"' % etag))
+
+    if '"%s"' % etag in environ.get('HTTP_IF_NONE_MATCH', ''):
+      start_response('304 Not Modified',
+                     [header for header in headers
+                      if header[0] not in ('Content-Type',
+                                           'Content-Encoding')])
+      return []
+
+    headers.append(('Content-Length', str(os.path.getsize(served_path))))
+    headers.append(('Last-Modified', time.strftime(
+        '%a, %d %b %Y %H:%M:%S GMT',
+        time.gmtime(os.path.getmtime(path)))))
+    start_response('200 OK', headers)
+    if environ['REQUEST_METHOD'] == 'HEAD':
+      return []
+
+    # Servers which provide a file wrapper can send the file directly
+    f = open(served_path, 'rb')
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper:
+      return file_wrapper(f, BLOCK_SIZE)
+    return _iter_file(f)
+
+
+def _iter_file(f):
+  try:
+    for block in iter(lambda: f.read(BLOCK_SIZE), ''):
+      yield block
+  finally:
+    f.close()
+
+
+def main(argv):
+  static_dir = argv[1] if len(argv) > 1 else os.path.join(
+      os.path.dirname(os.path.abspath(__file__)), 'static')
+  manifest = build(static_dir)
+  print 'Built %d static files into %s' % (
+      len(manifest), os.path.join(static_dir, DIST_DIR))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
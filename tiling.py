@@ -0,0 +1,109 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Helpers for mapping genomic windows onto fixed-size tiles.
+
+Windows are split into tiles whose size depends only on the width of the
+window (i.e. the zoom level), and whose boundaries are aligned to multiples
+of that size. Nearby windows at the same zoom therefore share tiles, and the
+upstream request for each tile can be cached and reused.
+"""
+
+import base64
+
+# The smallest tile, in bases
+MIN_TILE_SIZE = 1024
+
+# Tiles are sized so that a window spans at most about this many of them
+TILES_PER_WINDOW = 4
+
+# CIGAR operations which consume reference bases
+REFERENCE_OPERATIONS = frozenset([
+    'ALIGNMENT_MATCH', 'DELETE', 'SKIP', 'SEQUENCE_MATCH', 'SEQUENCE_MISMATCH'
+])
+
+
+def get_tile_size(start, end):
+  """Return the power-of-two tile size to use for a window"""
+  size = MIN_TILE_SIZE
+  while size * TILES_PER_WINDOW < end - start:
+    size *= 2
+  return size
+
+
+def get_tiles(start, end):
+  """Return the list of (start, end) tiles covering a window"""
+  size = get_tile_size(start, end)
+  tile_start = start - start % size
+  tiles = []
+  while tile_start < end or not tiles:
+    tiles.append((tile_start, tile_start + size))
+    tile_start += size
+  return tiles
+
+
+def encode_page_token(tile_start, page_token=None):
+  """Combine a tile and the upstream page token within it"""
+  return base64.urlsafe_b64encode('%d:%s' % (tile_start, page_token or ''))
+
+
+def decode_page_token(token):
+  """Split a token from encode_page_token into (tile_start, page_token)"""
+  try:
+    tile_start, page_token = \
+        base64.urlsafe_b64decode(token.encode('ascii')).split(':', 1)
+    return int(tile_start), page_token or None
+  except (TypeError, ValueError, UnicodeError):
+    return None, None
+
+
+def read_range(read):
+  """Return the reference range [start, end) covered by an aligned read"""
+  alignment = read.get('alignment')
+  if not alignment or 'position' not in alignment:
+    return None
+
+  start = int(alignment['position'].get('position', 0))
+  length = sum(int(op.get('operationLength', 0))
+               for op in alignment.get('cigar', [])
+               if op.get('operation') in REFERENCE_OPERATIONS)
+  return start, start + max(length, 1)
+
+
+def variant_range(variant):
+  """Return the reference range [start, end) covered by a variant"""
+  start = int(variant.get('start', 0))
+  return start, int(variant.get('end', start + 1))
+
+
+def trim(items, get_range, start, end, tile_start=None):
+  """Filter tile results down to the items that belong in a window.
+
+  Items not overlapping [start, end) are dropped. If tile_start is given,
+  items beginning before it are dropped too, since they were already
+  returned along with the previous tile. Items whose range can't be
+  determined are always kept.
+  """
+  trimmed = []
+  for item in items:
+    item_range = get_range(item)
+    if item_range:
+      item_start, item_end = item_range
+      if item_start >= end or item_end <= start:
+        continue
+      if tile_start is not None and item_start < tile_start:
+        continue
+    trimmed.append(item)
+  return trimmed
@@ -0,0 +1,162 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Request-scoped tracing.
+
+Each API request gets a Trace, identified by the X-Request-Id header the
+browser sent or else a new random ID. The browser gives all the requests
+for one pan or zoom IDs with a common prefix (like 3f9a1c-12.40), so their
+log lines can be found together. The stages of handling a request are
+timed in spans:
+
+  with trace.span('upstream', path='reads/search') as span:
+    ...
+    span['status'] = 200
+
+A span nests inside whichever span its thread has open; spans started in
+worker threads (see parallel.py) are top level. When a request finishes
+its timings are logged as a line of JSON, with the total time spent in each
+kind of span, and requests slower than a threshold have every span logged.
+"""
+
+import binascii
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+HEADER = 'X-Request-Id'
+
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+# Slow requests are logged here, so they can be sent somewhere of their own
+slow_log = logging.getLogger('tracing.slow')
+
+
+def get_request_id(header):
+  """Return the request ID a client sent, if it's sensible, or a new one"""
+  if header and _REQUEST_ID.match(header):
+    return header
+  return binascii.hexlify(os.urandom(8))
+
+
+class _Span(dict):
+  """A timed stage; its attributes are items of the dict"""
+
+  __slots__ = ('name', 'parent', 'thread', 'start', 'end')
+
+
+class Trace(object):
+  """The spans of one request, which threads may add to concurrently"""
+
+  def __init__(self, request_id, name):
+    self.request_id = request_id
+    self.name = name
+    self.start = time.time()
+    self.end = None
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._spans = []
+
+  @contextlib.contextmanager
+  def span(self, name, **attributes):
+    stack = getattr(self._local, 'stack', None)
+    if stack is None:
+      stack = self._local.stack = []
+
+    span = _Span(attributes)
+    span.name = name
+    span.parent = stack[-1] if stack else None
+    span.thread = threading.current_thread().name
+    span.start = time.time()
+    span.end = None
+    with self._lock:
+      self._spans.append(span)
+
+    stack.append(span)
+    try:
+      yield span
+    finally:
+      span.end = time.time()
+      stack.pop()
+
+  def finish(self):
+    self.end = time.time()
+
+  def get_totals(self):
+    """Return the count and total milliseconds of each kind of span.
+
+    Spans in concurrent threads overlap, so the totals can add up to more
+    than the request took.
+    """
+    totals = {}
+    with self._lock:
+      spans = list(self._spans)
+    for span in spans:
+      total = totals.setdefault(span.name, {'count': 0, 'ms': 0.0})
+      total['count'] += 1
+      total['ms'] += _milliseconds(span.start, span.end or time.time())
+    for total in totals.itervalues():
+      total['ms'] = round(total['ms'], 1)
+    return totals
+
+  def get_spans(self):
+    """Return every span as a dict, with times relative to the request"""
+    with self._lock:
+      spans = list(self._spans)
+    indexes = dict((id(span), i) for i, span in enumerate(spans))
+
+    results = []
+    for span in spans:
+      result = dict(span)
+      result.update({
+          'name': span.name,
+          'thread': span.thread,
+          'startMs': round(_milliseconds(self.start, span.start), 1),
+          'ms': round(_milliseconds(span.start, span.end or time.time()), 1),
+      })
+      if span.parent is not None:
+        result['parent'] = indexes[id(span.parent)]
+      results.append(result)
+    return results
+
+  def to_dict(self, spans=False, **attributes):
+    result = dict(attributes)
+    result.update({
+        'requestId': self.request_id,
+        'name': self.name,
+        'ms': round(_milliseconds(self.start, self.end or time.time()), 1),
+        'stages': self.get_totals(),
+    })
+    if spans:
+      result['spans'] = self.get_spans()
+    return result
+
+  def log(self, slow_seconds=None, **attributes):
+    """Log the trace, and every span too if it took slow_seconds or more"""
+    if self.end is None:
+      self.finish()
+    logging.info('trace %s', json.dumps(self.to_dict(**attributes),
+                                        sort_keys=True))
+    if slow_seconds is not None and self.end - self.start >= slow_seconds:
+      slow_log.warning('slow request %s', json.dumps(
+          self.to_dict(spans=True, **attributes), sort_keys=True))
+
+
+def _milliseconds(start, end):
+  return (end - start) * 1000
@@ -0,0 +1,176 @@
+"""
+Copyright 2016 Google Inc. All rights reserved.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A thread-safe, pooled HTTP transport for upstream APIs.
+
+An httplib2.Http object keeps a keep-alive connection to each host it has
+talked to, but can't be used by two threads at once. A Transport keeps a
+pool of them per host and checks one out for each request, so concurrent
+requests each get their own warm connection instead of queueing on one or
+opening (and handshaking) a fresh one every time.
+"""
+
+import logging
+import threading
+import time
+import urlparse
+
+import httplib2
+
+DEFAULT_MAX_CONNECTIONS = 10
+
+
+class PoolTimeout(Exception):
+  """Raised when no connection became free within the pool timeout"""
+
+
+def _connection_type(base, connect_timeout, read_timeout):
+  # Connect with the connect timeout, then switch the socket to the read
+  # timeout for the request itself.
+  class Connection(base):
+
+    def connect(self):
+      self.timeout = connect_timeout
+      base.connect(self)
+      self.timeout = read_timeout
+      if self.sock is not None:
+        self.sock.settimeout(read_timeout)
+
+  return Connection
+
+
+class _HostPool(object):
+
+  def __init__(self):
+    self.idle = []
+    self.in_use = 0
+
+    self.created = 0
+    self.requests = 0
+    self.reused = 0
+    self.waits = 0
+    self.wait_seconds = 0.0
+    self.timeouts = 0
+    self.errors = 0
+
+  def stats(self):
+    return {
+        'idle': len(self.idle),
+        'in_use': self.in_use,
+        'created': self.created,
+        'requests': self.requests,
+        'reused': self.reused,
+        'waits': self.waits,
+        'wait_seconds': self.wait_seconds,
+        'timeouts': self.timeouts,
+        'errors': self.errors,
+    }
+
+
+class Transport(object):
+  """A pool of httplib2.Http objects per host, with an Http-like request().
+
+  make_http is called (with a timeout) to create each Http object, so it can
+  also authorize it. At most max_connections requests run at once per host;
+  others wait up to pool_timeout seconds for one to finish. Connections are
+  made with connect_timeout and then read with read_timeout, except where
+  httplib2 hands requests to urlfetch (App Engine) or urllib3 (httplib2shim),
+  where read_timeout covers the whole request.
+  """
+
+  def __init__(self, make_http, max_connections=DEFAULT_MAX_CONNECTIONS,
+               connect_timeout=10, read_timeout=60, pool_timeout=30,
+               split_timeouts=True):
+    self.make_http = make_http
+    self.max_connections = max_connections
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.pool_timeout = pool_timeout
+
+    self._connection_types = None
+    if split_timeouts:
+      self._connection_types = {
+          'http': _connection_type(httplib2.HTTPConnectionWithTimeout,
+                                   connect_timeout, read_timeout),
+          'https': _connection_type(httplib2.HTTPSConnectionWithTimeout,
+                                    connect_timeout, read_timeout),
+      }
+
+    self._lock = threading.Condition(threading.Lock())
+    self._pools = {}
+
+  def _checkout(self, host):
+    with self._lock:
+      pool = self._pools.setdefault(host, _HostPool())
+      pool.requests += 1
+
+      if not pool.idle and pool.in_use >= self.max_connections:
+        pool.waits += 1
+        start_time = time.time()
+        deadline = start_time + self.pool_timeout
+        while not pool.idle and pool.in_use >= self.max_connections:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            pool.timeouts += 1
+            raise PoolTimeout('No connection to %s free after %ss' %
+                              (host, self.pool_timeout))
+          self._lock.wait(remaining)
+        pool.wait_seconds += time.time() - start_time
+
+      pool.in_use += 1
+      if pool.idle:
+        pool.reused += 1
+        return pool, pool.idle.pop()
+      pool.created += 1
+
+    # Create outside the lock, since authorizing may be slow
+    try:
+      return pool, self.make_http(timeout=self.read_timeout)
+    except:
+      self._checkin(pool, None)
+      raise
+
+  def _checkin(self, pool, http):
+    with self._lock:
+      pool.in_use -= 1
+      if http is not None:
+        pool.idle.append(http)
+      self._lock.notify()
+
+  def request(self, uri, method='GET', body=None, headers=None):
+    """Make a request, returning (response, content) like httplib2 does"""
+    scheme, host = urlparse.urlsplit(uri)[:2]
+    pool, http = self._checkout(host)
+
+    kwargs = {}
+    if self._connection_types and scheme in self._connection_types:
+      kwargs['connection_type'] = self._connection_types[scheme]
+    try:
+      response, content = http.request(uri, method=method, body=body,
+                                        headers=headers, **kwargs)
+    except:
+      # The connection may be left in any state, so don't reuse it
+      with self._lock:
+        pool.errors += 1
+      self._checkin(pool, None)
+      raise
+
+    self._checkin(pool, http)
+    return response, content
+
+  def stats(self):
+    with self._lock:
+      return dict((host, pool.stats())
+                  for host, pool in self._pools.iteritems())